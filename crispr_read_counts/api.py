@@ -0,0 +1,43 @@
+'''
+Python API of crisprReadCounts, for counting many samples in one interpreter without writing and re-reading files.
+
+Libraries are loaded once and count reads from an iterable, a CRAM file or FastQ files. Counting returns objects holding
+count arrays aligned with the library and the stats of the counting. Invalid inputs raise CrisprReadCountsError.
+
+  library = SingleGuideLibrary.from_file('library.tsv')
+  results = [library.count_cram(cram, 'genome.fa') for cram in crams]
+  merged = merge_single_counts(results)
+
+  dual_library = DualGuideLibrary.from_file('dual_library.tsv')
+  sample = dual_library.count_fastq('r1.fq.gz', 'r2.fq.gz', 'sample_name')
+  row_counts, stats = sample.get_row_counts(dual_library), sample.get_stats(dual_library)
+
+Counting methods of files accept sample_reads or sample_fraction to count only reads sampled across the input, the
+stats then include estimates for the full input.
+
+Plasmid counts are loaded aligned with a library, from a plasmid count TSV file or a compiled one (memory-mapped):
+
+  plasmid = load_plasmid_counts('plasmid_counts.tsv', library)
+  write_compiled_plasmid(plasmid, library, 'plasmid_counts.bin')
+'''
+from .utils import CrisprReadCountsError
+from .single_guide_count import SingleGuideLibrary, SingleGuideCounts, SingleGuideDiagnostics, fastq_reads
+from .single_guide_merge import merge_single_counts
+from .plasmid import PlasmidCounts, load_plasmid_counts, write_compiled_plasmid
+from .dual_guide_count import DualGuideLibrary, DualGuideSampleCounts, fastq_read_pairs, read_barcode_sheet
+
+__all__ = [
+  'CrisprReadCountsError',
+  'SingleGuideLibrary',
+  'SingleGuideCounts',
+  'SingleGuideDiagnostics',
+  'fastq_reads',
+  'merge_single_counts',
+  'PlasmidCounts',
+  'load_plasmid_counts',
+  'write_compiled_plasmid',
+  'DualGuideLibrary',
+  'DualGuideSampleCounts',
+  'fastq_read_pairs',
+  'read_barcode_sheet',
+]
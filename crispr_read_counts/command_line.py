@@ -39,7 +39,7 @@ def cli():
 @click.option(
   '--plasmid', '-p',
   metavar='FILE',
-  help='Plasmid count tsv file.')
+  help='Plasmid count tsv file, or plasmid counts compiled for the library by "compile-plasmid".')
 @click.option(
   '--reverse-complement', '-rc',
   default=False,
@@ -55,11 +55,69 @@ def cli():
   help='Delimiter of the guide library file. On Unix with bash, use \'$\' in front of your delimiter '
        'if it starts with a backslash. e.g.: --delimiter $\'\\t\'. Default: tab.',
   default='\t')
+@click.option(
+  '--umi-tag',
+  metavar='TAG',
+  help='Tag of the reads holding their UMI (e.g. RX). When given, reads are also counted once per guide and UMI.')
+@click.option(
+  '--umi-regex',
+  metavar='REGEX',
+  help='Regular expression to find UMI in read names (the first group is used if there is one). '
+       'When given, reads are also counted once per guide and UMI.')
+@click.option(
+  '--sample-reads',
+  metavar='INT',
+  type=int,
+  help='Only count about N reads sampled across the input (by whole CRAM containers), and estimate stats of the full '
+       'input with 95% confidence intervals. For a quick QC check before a full run.')
+@click.option(
+  '--sample-fraction',
+  metavar='FLOAT',
+  type=float,
+  help='As "--sample-reads", but sampling a fraction (between 0 and 1) of the reads.')
+@click.option(
+  '--diagnostics',
+  metavar='FILE',
+  help='Output file path of hit rate diagnostics in JSON format: reads mapped to guides with every trim offset in both '
+       'orientations, and the most frequent unmatched sequences, from a subsample of the reads.')
+@click.option(
+  '--diagnostics-interval',
+  metavar='INT',
+  type=int,
+  default=100,
+  show_default=True,
+  help='Diagnose every N-th read.')
 def count_single(**kwargs):
   from .single_guide_count import count_single
   count_single(kwargs)
 
 
+@cli.command()
+@click.option(
+  '--plasmid', '-p',
+  metavar='FILE',
+  required=True,
+  help='Plasmid count tsv file.')
+@click.option(
+  '--library', '-l',
+  metavar='FILE',
+  required=True,
+  help='Input single guide library file, as used by "count-single".')
+@click.option(
+  '--output', '-o',
+  metavar='FILE',
+  required=True,
+  help='Output compiled plasmid counts file, for the "--plasmid" option of "count-single" runs with the same library.')
+@click.option(
+  '--lib-delimiter', '-d',
+  metavar='CHAR',
+  help='Delimiter of the guide library file. Default: tab.',
+  default='\t')
+def compile_plasmid(**kwargs):
+  from .single_guide_count import compile_plasmid
+  compile_plasmid(kwargs)
+
+
 @cli.command()
 @click.option(
   '--library', '-l',
@@ -70,22 +128,35 @@ def count_single(**kwargs):
   '--fastq1', '-f1',
   required=True,
   metavar='FILE',
-  help='R1 fastq file.')
+  help='R1 fastq file (path or http(s) URL).')
 @click.option(
   '--fastq2', '-f2',
   required=True,
   metavar='FILE',
-  help='R2 fastq file.')
+  help='R2 fastq file (path or http(s) URL).')
 @click.option(
   '--sample', '-n',
   metavar='STRING',
-  required=True,
-  help='Sample name.')
+  help='Sample name. Required unless "--barcodes" is used.')
+@click.option(
+  '--barcodes', '-b',
+  metavar='FILE',
+  help='Tab delimited barcode sheet with "sample" and "barcode" columns, for demultiplexing read pairs of many samples '
+       'by the inline barcode at the start of R1. Counts are written as one column per sample and stats as one row per sample.')
 @click.option(
   '--reads', '-r',
   metavar='FILE',
   required=True,
   help='Output classified reads file.')
+@click.option(
+  '--reads-shards',
+  metavar='INT',
+  type=int,
+  default=0,
+  help='Write the classified reads into N BGZF-compressed files (<reads>.<shard>.gz), by chunks of reads going round robin '
+       'to the shards, each compressed by its own thread. <reads>.index.tsv lists the chunks in read order with their '
+       'shard, byte offset and size: concatenating these byte ranges in order gives a BGZF file of the reads in order. '
+       'Default: a single plain text file in read order.')
 @click.option(
   '--stats', '-s',
   metavar='FILE',
@@ -96,6 +167,35 @@ def count_single(**kwargs):
   metavar='FILE',
   required=True,
   help='Output read counts result file.')
+@click.option(
+  '--umi-regex',
+  metavar='REGEX',
+  help='Regular expression to find UMI in the read header lines of R1 (the first group is used if there is one). '
+       'When given, read pairs are also counted once per guide pair and UMI.')
+@click.option(
+  '--sample-reads',
+  metavar='INT',
+  type=int,
+  help='Only count about N read pairs sampled across the input (FastQ files must be BGZF-compressed, e.g. by bgzip, '
+       'or uncompressed), and estimate stats of the full input with 95% confidence intervals. For a quick QC check '
+       'before a full run.')
+@click.option(
+  '--sample-fraction',
+  metavar='FLOAT',
+  type=float,
+  help='As "--sample-reads", but sampling a fraction (between 0 and 1) of the reads.')
+@click.option(
+  '--prefetch-threads',
+  metavar='INT',
+  type=int,
+  default=0,
+  help='Read the FastQ files with N threads fetching large byte ranges ahead, for inputs on high latency storage. '
+       'FastQ files can also be http(s) URLs (of servers supporting range requests), which are always read this way.')
+@click.option(
+  '--low-memory',
+  is_flag=True,
+  help='Keep the guide pairs of the library only as a sorted array looked up by binary search, for very large '
+       'combinatorial libraries: about half the memory, but read pairs are classified about 20% slower.')
 def count_dual(**kwargs):
   from .dual_guide_count import count_dual
   count_dual(kwargs)
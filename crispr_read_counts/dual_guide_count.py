@@ -1,14 +1,32 @@
+import re
 import sys
-from typing import List
+import zlib
+from array import array
+from bisect import bisect_left
+from typing import List, Dict, Iterable, Tuple, TextIO
 from .utils import (
   error_msg,
   warning_msg,
   open_plain_or_gzipped_file,
   rev_compl,
+  get_umi_from_read_name,
+  CrisprReadCountsError,
+  UmiCounts,
+  DNA_PATTERN,
   SAFE_SEQ_FORMAT,
   check_file_readable,
   check_file_writable)
-
+from .sampling import check_sampling_options, FastqSampler, estimate_full_depth_stats
+from .prefetch import is_url
+from .reads_shards import ShardedReadsWriter
+
+BARCODE_SHEET_EXPECTED_HEADER = ['sample', 'barcode']
+DUAL_STATS_COLUMNS = [
+  'total_reads', 'miss', 'mismatch', 'gRNA1_hits', 'gRNA2_hits', 'safe_safe',
+  'gRNA1_safe', 'safe_gRNA2', 'gRNA1_gRNA2', 'total_guides', 'zero_guides', 'less_30_guides']
+LOW_COUNT_GUIDES_THRESHOLD = 30
+# uncompressed size of the blocks of library row unique_id values
+UNIQUE_ID_BLOCK_SIZE = 256 * 1024
 DUAL_LIBRARY_EXPECTED_HEADER = ['sgrna_left_id', 'sgrna_left_seq', 'sgrna_right_id', 'sgrna_right_seq', 'unique_id', 'gene_pair_id', 'target_id']
 
 
@@ -18,46 +36,248 @@ def count_dual(args):
   # unique_id, target_id, gener_pair_id, sgrna_left_seq_id, sgrna_left_seg, sgrna_right_seq_id, sgrna_right_seg
   # unique_id, target_id, gener_pair_id are informative fields that get passed along to output reports
 
-  # Create various lookup dictionaries from the library file
   validate_inputs(args)
-  (lookupGuidePair, lookupGuideLeft, lookupGuideRight, lookupGuideLeftRC,
-   lookupGuideRightRC, lookupSafe, header_index) = library_to_dicts(args['library'])
-
-  (n_safe_safe, n_grna1_safe, n_safe_grna2,
-   n_grna1_grna2, n_grna1, n_grna2, n_incorrect_pair, n_miss_miss, read_counts
-   ) = write_classified_reads_to_file_return_stats(
-      args['fastq1'], args['fastq2'], args['reads'], args['sample'],
-      lookupGuidePair, lookupGuideLeft, lookupGuideRight, lookupGuideLeftRC, lookupGuideRightRC, lookupSafe)
-
-  total_guides, zero_guides, less_30_guides = write_guides_return_stats(
-    args['library'], args['counts'], args['sample'], lookupGuidePair, header_index)
-
+  reads_shards = args.get('reads_shards') or 0
+  if reads_shards < 0:
+    sys.exit(error_msg('Number of classified reads shards must be a positive integer.'))
+  umi_regex = None
+  if args.get('umi_regex'):
+    try:
+      umi_regex = re.compile(args['umi_regex'])
+    except re.error as e:
+      sys.exit(error_msg(f'Invalid UMI regular expression: {e}'))
+  sample_reads, sample_fraction = args.get('sample_reads'), args.get('sample_fraction')
+  try:
+    check_sampling_options(sample_reads, sample_fraction)
+    barcodes, barcode_length = None, 0
+    if args.get('barcodes'):
+      sample_names, barcodes, barcode_length = read_barcode_sheet(args['barcodes'])
+    else:
+      sample_names = [args['sample']]
+
+    # Create the compact guide lookup from the library file
+    guide_lib = library_to_lookup(args['library'], args.get('low_memory', False))
+  except CrisprReadCountsError as e:
+    sys.exit(error_msg(str(e)))
+  samples = [DualGuideSampleCounts(sample_name, guide_lib, umi_regex is not None) for sample_name in sample_names]
+
+  try:
+    sampling_fraction = write_classified_reads(
+      args['fastq1'], args['fastq2'], args['reads'], guide_lib, samples, umi_regex, barcodes, barcode_length,
+      sample_reads, sample_fraction, args.get('prefetch_threads') or 0, reads_shards)
+  except CrisprReadCountsError as e:
+    sys.exit(error_msg(str(e)))
+  for sample in samples:
+    sample.sampling_fraction = sampling_fraction
+
+  write_guide_counts(args['counts'], guide_lib, samples)
+
+  sample_stats = [sample.get_stats(guide_lib) for sample in samples]
   write_stats(
     args['stats'],
-    ['sample', 'total_reads', 'miss', 'mismatch', 'gRNA1_hits', 'gRNA2_hits', 'safe_safe',
-     'gRNA1_safe', 'safe_gRNA2', 'gRNA1_gRNA2', 'total_guides', 'zero_guides', 'less_30_guides'],
-    [
-      args['sample'],
-      *[
-        str(int(number)) for number in
-        [read_counts, n_miss_miss, n_incorrect_pair, n_grna1, n_grna2,
-         n_safe_safe, n_grna1_safe, n_safe_grna2, n_grna1_grna2, total_guides, zero_guides, less_30_guides]
-      ]
-    ])
+    ['sample', *sample_stats[0].keys()],
+    # estimates that can not be made from the sampled reads are NA
+    [[sample.name, *['NA' if number is None else str(number) for number in stats.values()]]
+     for sample, stats in zip(samples, sample_stats)])
 
 
 def validate_inputs(args):
   for file_type, file_path in zip(['library', 'FastQ', 'FastQ'], [args['library'], args['fastq1'], args['fastq2']]):
+    if file_type == 'FastQ' and is_url(file_path):
+      continue
     check_file_readable(file_path, f'Provided {file_type} file does not exist or have no permission to read: {file_path}')
 
+  if args.get('barcodes'):
+    check_file_readable(args['barcodes'], f'Provided barcode sheet does not exist or have no permission to read: {args["barcodes"]}')
+    if args.get('sample'):
+      sys.exit(error_msg('Options "--sample" and "--barcodes" can not be used together, sample names are read from the barcode sheet.'))
+  elif not args.get('sample'):
+    sys.exit(error_msg('Either "--sample" or "--barcodes" must be provided.'))
+
   for file_type, file_path in zip(['classified reads', 'counts', 'stats'], [args['reads'], args['counts'], args['stats']]):
     check_file_writable(file_path, f'Cannot write to provided output {file_type} file: {file_path}.')
 
 
-def library_to_dicts(library: str):
-
-  lookupGuidePair, header_index = {}, {}
-  lookupGuideLeft, lookupGuideRight, lookupGuideLeftRC, lookupGuideRightRC, lookupSafe = set(), set(), set(), set(), set()
+def read_barcode_sheet(barcode_sheet: str):
+  '''
+  read a tab delimited file with "sample" and "barcode" columns, returns the sample names, a dict of barcode to the index
+  of its sample and the barcode length.
+  '''
+  sample_names, barcodes = [], {}
+  with open(barcode_sheet) as f:
+    header = [col_name.lower() for col_name in f.readline().strip().split('\t')]
+    for expected_col_name in BARCODE_SHEET_EXPECTED_HEADER:
+      if expected_col_name not in header:
+        raise CrisprReadCountsError(f'Cound not find named column: {expected_col_name} in the barcode sheet, please check file columns and try again.')
+    sample_col, barcode_col = header.index('sample'), header.index('barcode')
+
+    for line_number, line in enumerate(f, 2):
+      if not line.strip():
+        continue
+      line_split = line.strip().split('\t')
+      if len(line_split) <= max(sample_col, barcode_col):
+        raise CrisprReadCountsError(f'Barcode sheet line: {line_number} does not have enough columns.')
+      sample_name, barcode = line_split[sample_col], line_split[barcode_col].upper()
+      if not DNA_PATTERN.match(barcode):
+        raise CrisprReadCountsError(f'Barcode column contains non-DNA characters on line: {line_number}.')
+      if barcode in barcodes:
+        raise CrisprReadCountsError(f'Barcode {barcode} on line: {line_number} is duplicated.')
+      if sample_name in sample_names:
+        raise CrisprReadCountsError(f'Sample name {sample_name} on line: {line_number} is duplicated.')
+      barcodes[barcode] = len(sample_names)
+      sample_names.append(sample_name)
+
+  if not sample_names:
+    raise CrisprReadCountsError('Barcode sheet has no samples.')
+  barcode_lengths = set(len(barcode) for barcode in barcodes)
+  if len(barcode_lengths) > 1:
+    raise CrisprReadCountsError('Barcodes in the barcode sheet must have the same length.')
+
+  return sample_names, barcodes, barcode_lengths.pop()
+
+
+class DualGuideLibrary:
+  '''
+  Compact lookup structure of a dual guide library.
+
+  Each distinct single guide sequence is stored once and given an integer index, with a flag byte recording whether
+  it is used as a left guide, a right guide and/or is a safe guide. Guide pairs are kept as a sorted array of integer
+  codes (left index in the high 32 bits, right index in the low 32 bits), so the position of a pair in the array is
+  its index into a count array. Pairs are looked up in a dict of code to index, or by binary search of the array in
+  low memory mode, which takes about half the memory for large libraries but counts read pairs about a third slower.
+
+  Library rows are kept in file order, so counts can be reported per row without reading the library file again: the
+  unique_id values (one per row) are stored newline terminated in zlib-compressed blocks, target_id and gene_pair_id
+  values (repeated across many rows) are stored once in a label table referenced by index, and the index of the row's
+  guide pair is kept in an array.
+  '''
+
+  LEFT, RIGHT, SAFE = 1, 2, 4
+
+  def __init__(self, low_memory: bool = False):
+    self.low_memory = low_memory
+    self.guide_index: Dict[str, int] = {}
+    self.guide_rc_index: Dict[str, int] = {}
+    self.guide_seqs: List[str] = []
+    self.guide_flags = bytearray()
+    self.pair_codes = array('Q')
+    # index of each pair code, None in low memory mode
+    self.pair_lookup: Dict[int, int] = None
+    self.labels: List[bytes] = []
+    self.row_unique_id_blocks: List[bytes] = []
+    self.pending_unique_ids = bytearray()
+    self.row_target_ids = array('I')
+    self.row_gene_pair_ids = array('I')
+    self.row_pairs = array('I')
+
+  def __len__(self):
+    return len(self.pair_codes)
+
+  def add_guide(self, seq: str, flags: int) -> int:
+    guide = self.guide_index.get(seq)
+    if guide is None:
+      guide = len(self.guide_seqs)
+      seq = sys.intern(seq)
+      self.guide_index[seq] = guide
+      self.guide_rc_index[rev_compl(seq)] = guide
+      self.guide_seqs.append(seq)
+      self.guide_flags.append(flags)
+    else:
+      self.guide_flags[guide] |= flags
+    return guide
+
+  def set_pair_codes(self, pair_codes):
+    self.pair_codes = pair_codes
+    self.pair_lookup = None if self.low_memory else {code: index for index, code in enumerate(pair_codes)}
+
+  def pair_index(self, left: int, right: int) -> int:
+    '''
+    index of the guide pair in the count array, -1 if the pair is not in the library.
+    '''
+    code = left << 32 | right
+    if self.pair_lookup is not None:
+      return self.pair_lookup.get(code, -1)
+    index = bisect_left(self.pair_codes, code)
+    if index < len(self.pair_codes) and self.pair_codes[index] == code:
+      return index
+    return -1
+
+  def pair_index_by_seqs(self, left_seq: str, right_seq: str) -> int:
+    left, right = self.guide_index.get(left_seq), self.guide_index.get(right_seq)
+    if left is None or right is None:
+      return -1
+    return self.pair_index(left, right)
+
+  def new_counts(self):
+    return array('L', [0]) * len(self.pair_codes)
+
+  def add_row_unique_id(self, unique_id: str):
+    self.pending_unique_ids += unique_id.encode() + b'\n'
+    if len(self.pending_unique_ids) >= UNIQUE_ID_BLOCK_SIZE:
+      self.flush_unique_ids()
+
+  def flush_unique_ids(self):
+    if self.pending_unique_ids:
+      self.row_unique_id_blocks.append(zlib.compress(self.pending_unique_ids, 1))
+      self.pending_unique_ids = bytearray()
+
+  def iter_row_labels(self) -> Iterable[bytes]:
+    '''
+    tab-joined unique_id, target_id and gene_pair_id of the library rows.
+    '''
+    unique_ids = (
+      unique_id for block in self.row_unique_id_blocks for unique_id in zlib.decompress(block).split(b'\n')[:-1])
+    labels = self.labels
+    for unique_id, target_id, gene_pair_id in zip(unique_ids, self.row_target_ids, self.row_gene_pair_ids):
+      yield b'%s\t%s\t%s' % (unique_id, labels[target_id], labels[gene_pair_id])
+
+  @staticmethod
+  def from_file(library: str, low_memory: bool = False) -> 'DualGuideLibrary':
+    return library_to_lookup(library, low_memory)
+
+  def count_read_pairs(self, read_pairs: Iterable[Tuple[str, str, str]], sample_name: str, umi_regex=None) -> 'DualGuideSampleCounts':
+    '''
+    count (R1 header line, R1 sequence, R2 sequence) tuples of a sample, the classified reads are not written.
+    '''
+    sample = DualGuideSampleCounts(sample_name, self, umi_regex is not None)
+    classify_read_pairs(self, read_pairs, [sample], re.compile(umi_regex) if umi_regex else None)
+    return sample
+
+  def count_fastq(self, fastq1: str, fastq2: str, sample_name: str, umi_regex=None,
+                  sample_reads: int = None, sample_fraction: float = None,
+                  prefetch_threads: int = 0) -> 'DualGuideSampleCounts':
+    '''
+    count read pairs of (gzipped) R1 and R2 FastQ files. If sample_reads or sample_fraction is given, only chunks of read
+    pairs spread across the files are counted and stats of the full files are estimated, the files must then be
+    BGZF-compressed or uncompressed. FastQ files may be http(s) URLs, they are read with prefetch_threads threads (or a
+    default number of threads) fetching byte ranges ahead.
+    '''
+    if sample_reads or sample_fraction:
+      sampler = FastqSampler(fastq1, fastq2, sample_reads, sample_fraction)
+      sample = DualGuideSampleCounts(sample_name, self, umi_regex is not None)
+      classify_read_pairs(self, sampled_read_pairs(sampler, [sample]), [sample], re.compile(umi_regex) if umi_regex else None)
+      sample.sampling_fraction = sampler.fraction
+      return sample
+
+    with open_plain_or_gzipped_file(fastq1, prefetch_threads) as fq1, open_plain_or_gzipped_file(fastq2, prefetch_threads) as fq2:
+      return self.count_read_pairs(fastq_read_pairs(fq1, fq2), sample_name, umi_regex)
+
+
+def library_to_lookup(library: str, low_memory: bool = False):
+
+  header_index = {}
+  guide_lib = DualGuideLibrary(low_memory)
+  # guide indexes of each row, pairs are sorted and de-duplicated once all rows are read
+  row_lefts, row_rights = array('I'), array('I')
+  # index of each target_id and gene_pair_id value in the label table
+  label_index = {}
+
+  def get_label(label: str) -> int:
+    index = label_index.get(label)
+    if index is None:
+      index = label_index[label] = len(guide_lib.labels)
+      guide_lib.labels.append(label.encode())
+    return index
 
   with open(library) as f:
     header = f.readline().strip().split('\t')
@@ -70,128 +290,309 @@ def library_to_dicts(library: str):
     # check if all expeted headers are foundi in the input library file
     for expected_col_name in DUAL_LIBRARY_EXPECTED_HEADER:
       if expected_col_name not in header_index.keys():
-        sys.exit(error_msg(f'Cound not find named column: {expected_col_name} in the input library file, please check file columns and try again.'))
+        raise CrisprReadCountsError(f'Cound not find named column: {expected_col_name} in the input library file, please check file columns and try again.')
 
     header_index_left_seq = header_index['sgrna_left_seq']
     header_index_right_seq = header_index['sgrna_right_seq']
     header_index_left_id = header_index['sgrna_left_id']
     header_index_right_id = header_index['sgrna_right_id']
+    header_index_unique_id = header_index['unique_id']
+    header_index_target_id = header_index['target_id']
+    header_index_gene_pair_id = header_index['gene_pair_id']
 
+    LEFT, RIGHT, SAFE = DualGuideLibrary.LEFT, DualGuideLibrary.RIGHT, DualGuideLibrary.SAFE
+    guide_index, guide_flags = guide_lib.guide_index, guide_lib.guide_flags
+    row_target_ids, row_gene_pair_ids = guide_lib.row_target_ids, guide_lib.row_gene_pair_ids
     for line in f:
       line_split = line.strip().split('\t')
-      sgSeqL = line_split[header_index_left_seq]
-      sgSeqR = line_split[header_index_right_seq]
-      sgSeqLrc = rev_compl(sgSeqL)
-      sgSeqRrc = rev_compl(sgSeqR)
-      lookupGuideLeft.add(sgSeqL)
-      lookupGuideRight.add(sgSeqR)
-      lookupGuideLeftRC.add(sgSeqLrc)
-      lookupGuideRightRC.add(sgSeqRrc)
       # store the safe sequences (guide id starts with F followed by a number)
-      if SAFE_SEQ_FORMAT.match(line_split[header_index_left_id]):
-        lookupSafe.add(sgSeqL)
-      if SAFE_SEQ_FORMAT.match(line_split[header_index_right_id]):
-        lookupSafe.add(sgSeqR)
-      lookupGuidePair[sgSeqLrc + sgSeqR] = 0
-
-  return lookupGuidePair, lookupGuideLeft, lookupGuideRight, lookupGuideLeftRC, lookupGuideRightRC, lookupSafe, header_index
-
-
-def write_classified_reads_to_file_return_stats(
-  fastq1: str, fastq2: str, out_reads: str, sample_name: str,
-  lookupGuidePair, lookupGuideLeft, lookupGuideRight, lookupGuideLeftRC, lookupGuideRightRC, lookupSafe):
-
-  n_safe_safe, n_grna1_safe, n_safe_grna2, n_grna1_grna2, n_grna1, n_grna2, n_incorrect_pair, n_miss_miss = 0, 0, 0, 0, 0, 0, 0, 0
-
-  read_id = None
-  with open_plain_or_gzipped_file(
-    fastq1) as fq1, open_plain_or_gzipped_file(fastq2) as fq2, open(out_reads, 'w') as classified_reads:
-    for line_index, r1 in enumerate(fq1, 1):
-      r2 = fq2.readline()
-      residue = (line_index) % 4  # to figure which of the 4 line of a read recored this line is
-      if residue == 1:
-        read_id = r1[1:-3]
-      elif residue == 2:
-        r1 = r1.strip()
-        r2 = r2.strip()
-        pair_guide = r2 + r1
-        # look for correctly paired reads:
-        # Reverse Complement (Read2) -> gRNA1 (left); Read1 -> gRNA2 (right)
-        if pair_guide in lookupGuidePair:
-          lookupGuidePair[pair_guide] += 1
-          r2rc = rev_compl(r2)
-          label1 = 'safe' if r2rc in lookupSafe else 'gRNA1'
-          label1_safe: bool = label1 == 'safe'
-          label2 = 'safe' if r1 in lookupSafe else 'gRNA2'
-          label2_safe: bool = label2 == 'safe'
-          # count number of occurrances
-          if not label1_safe and not label2_safe:
-            n_grna1_grna2 += 1
-          elif not label1_safe and label2_safe:
-            n_grna1_safe += 1
-          elif label1_safe and not label2_safe:
-            n_safe_grna2 += 1
-          else:
-            n_safe_safe += 1
-          classified_reads.write('\t'.join(['FOUND', f'{label1}_{label2}', sample_name, read_id, r1, r2, f'{r2rc}{r1}']) + '\n')
-
-        # both guides found but they are incorrectly paired (most reads fall here)
-        elif r2 in lookupGuideLeftRC and r1 in lookupGuideRight:
-          n_incorrect_pair += 1
-          classified_reads.write('\t'.join(['MISS', 'gRNA1_gRNA2', sample_name, read_id, r1, r2, 'NA']) + '\n')
-        # both guides found but they are incorrectly paired and have wrong orientation
-        # few reads fall here
-        elif r1 in lookupGuideLeft and r2 in lookupGuideRightRC:
-          n_incorrect_pair += 1
-          classified_reads.write('\t'.join(['MISS', 'gRNA1_gRNA2', sample_name, read_id, r1, r2, 'NA']) + '\n')
-        # only found the left guide (with either correct or wrong orientation)
-        elif r2 in lookupGuideLeftRC or r1 in lookupGuideLeft:
-          n_grna1 += 1
-          classified_reads.write('\t'.join(['MISS', 'gRNA1_nothing', sample_name, read_id, r1, r2, 'NA']) + '\n')
-        # only found the right guide (with either correct or wrong orientation)
-        elif r1 in lookupGuideRight or r2 in lookupGuideRightRC:
-          n_grna2 += 1
-          classified_reads.write('\t'.join(['MISS', 'nothing_gRNA2', sample_name, read_id, r1, r2, 'NA']) + '\n')
-        # didn't match any guides
-        else:
-          n_miss_miss += 1
-          classified_reads.write('\t'.join(['MISS', 'nothing_nothing', sample_name, read_id, r1, r2, 'NA']) + '\n')
+      left_flags = LEFT | (SAFE if SAFE_SEQ_FORMAT.match(line_split[header_index_left_id]) else 0)
+      left = guide_index.get(line_split[header_index_left_seq])
+      if left is None:
+        left = guide_lib.add_guide(line_split[header_index_left_seq], left_flags)
+      else:
+        guide_flags[left] |= left_flags
+      right_flags = RIGHT | (SAFE if SAFE_SEQ_FORMAT.match(line_split[header_index_right_id]) else 0)
+      right = guide_index.get(line_split[header_index_right_seq])
+      if right is None:
+        right = guide_lib.add_guide(line_split[header_index_right_seq], right_flags)
+      else:
+        guide_flags[right] |= right_flags
+      row_lefts.append(left)
+      row_rights.append(right)
+      guide_lib.add_row_unique_id(line_split[header_index_unique_id])
+      target_id = label_index.get(line_split[header_index_target_id])
+      row_target_ids.append(get_label(line_split[header_index_target_id]) if target_id is None else target_id)
+      gene_pair_id = label_index.get(line_split[header_index_gene_pair_id])
+      row_gene_pair_ids.append(get_label(line_split[header_index_gene_pair_id]) if gene_pair_id is None else gene_pair_id)
+
+  guide_lib.flush_unique_ids()
+  guide_lib.set_pair_codes(sorted_unique_pair_codes(row_lefts, row_rights, len(guide_lib.guide_seqs)))
+  # the pair index of each row replaces its left guide index, no other per row array is needed
+  if guide_lib.pair_lookup is not None:
+    pair_lookup = guide_lib.pair_lookup
+    for row, right in enumerate(row_rights):
+      row_lefts[row] = pair_lookup[row_lefts[row] << 32 | right]
+  else:
+    for row, right in enumerate(row_rights):
+      row_lefts[row] = guide_lib.pair_index(row_lefts[row], right)
+  guide_lib.row_pairs = row_lefts
+
+  return guide_lib
+
+
+def sorted_unique_pair_codes(lefts, rights, n_guides: int):
+  '''
+  bucket the right guides by their left guide so that only one bucket at a time is sorted as a Python list, this keeps
+  the peak memory close to the size of the arrays. A pair appearing on more than one row gets one code.
+  '''
+  bucket_ends = array('I', [0]) * n_guides
+  for left in lefts:
+    bucket_ends[left] += 1
+  total = 0
+  for guide in range(n_guides):
+    total += bucket_ends[guide]
+    bucket_ends[guide] = total
+
+  # fill the buckets backwards, each bucket end ends up being the start of the bucket
+  bucketed_rights = array('I', [0]) * len(rights)
+  for left, right in zip(lefts, rights):
+    bucket_ends[left] -= 1
+    bucketed_rights[bucket_ends[left]] = right
+
+  pair_codes = array('Q')
+  for left in range(n_guides):
+    start = bucket_ends[left]
+    end = bucket_ends[left + 1] if left + 1 < n_guides else len(bucketed_rights)
+    pair_codes.extend(left << 32 | right for right in sorted(set(bucketed_rights[start:end])))
+
+  return pair_codes
+
+
+class DualGuideSampleCounts:
+  '''
+  Counts of one sample: read pairs of each guide pair (and deduplicated by UMI if required), and numbers of read pairs
+  of each classification. If the read pairs were sampled, sampling_fraction is the fraction of the input they are and
+  chunk_hits the numbers of (read pairs, counted read pairs) of each sampled chunk.
+  '''
+
+  def __init__(self, name: str, guide_lib: DualGuideLibrary, with_umi: bool = False):
+    self.name = name
+    self.pair_counts = guide_lib.new_counts()
+    self.umi_counts = UmiCounts(len(guide_lib)) if with_umi else None
+    self.n_reads = 0
+    self.n_safe_safe, self.n_grna1_safe, self.n_safe_grna2, self.n_grna1_grna2 = 0, 0, 0, 0
+    self.n_grna1, self.n_grna2, self.n_incorrect_pair, self.n_miss_miss = 0, 0, 0, 0
+    self.sampling_fraction = None
+    self.chunk_hits = None
+
+  def get_row_counts(self, guide_lib: DualGuideLibrary):
+    # counts in library row order, rows of the same guide pair share the count
+    return array('L', (self.pair_counts[pair] for pair in guide_lib.row_pairs))
+
+  def get_counted_reads(self) -> int:
+    return self.n_safe_safe + self.n_grna1_safe + self.n_safe_grna2 + self.n_grna1_grna2
+
+  def get_stats(self, guide_lib: DualGuideLibrary) -> Dict[str, int]:
+    '''
+    stats in the columns of the stats file, followed by the estimated stats of the full input if reads were sampled.
+    '''
+    row_counts = self.get_row_counts(guide_lib)
+    stats = dict(zip(DUAL_STATS_COLUMNS, [
+      self.n_reads, self.n_miss_miss, self.n_incorrect_pair, self.n_grna1, self.n_grna2,
+      self.n_safe_safe, self.n_grna1_safe, self.n_safe_grna2, self.n_grna1_grna2,
+      len(row_counts), row_counts.count(0), sum(1 for count in row_counts if count < LOW_COUNT_GUIDES_THRESHOLD)]))
+    if self.sampling_fraction is not None:
+      stats.update(estimate_full_depth_stats(
+        row_counts, self.n_reads, self.get_counted_reads(), self.sampling_fraction, LOW_COUNT_GUIDES_THRESHOLD,
+        'zero_guides', 'less_30_guides', self.chunk_hits))
+    return stats
+
+
+def fastq_read_pairs(fq1, fq2):
+  '''
+  (R1 header line, R1 sequence, R2 sequence) of the read pairs in opened R1 and R2 FastQ files.
+  '''
+  line_index, header = 0, None
+  for line_index, r1 in enumerate(fq1, 1):
+    r2 = fq2.readline()
+    residue = (line_index) % 4  # to figure which of the 4 line of a read recored this line is
+    if residue == 1:
+      header = r1
+    elif residue == 2:
+      yield header, r1.strip(), r2.strip()
 
   if (line_index) % 4 != 0:
     print(warning_msg('Number of lines in provided FastQ files is not multiple times of 4, truncated file?'), flush=True)
 
-  read_counts = int((line_index + 1) / 4)
 
-  return n_safe_safe, n_grna1_safe, n_safe_grna2, n_grna1_grna2, n_grna1, n_grna2, n_incorrect_pair, n_miss_miss, read_counts
-
-
-def write_guides_return_stats(library: str, out_counts: str, sample_name: str, lookupGuidePair, header_index):
-  zero_guides, less_30_guides = 0, 0
-  with open(library, 'r') as lib, open(out_counts, 'w') as out_ct:
-    next(lib)
-    out_ct.write('\t'.join(['unique_id', 'target_id', 'gene_pair_id', sample_name]) + '\n')
-    for line_count, line in enumerate(lib, 1):
-      ele = line.strip().split('\t')
-      sgSeqL = ele[header_index['sgrna_left_seq']]
-      sgSeqR = ele[header_index['sgrna_right_seq']]
-      gene_pair_id = ele[header_index['gene_pair_id']]
-      unique_pair_id = ele[header_index['unique_id']]
-      target_pair_id = ele[header_index['target_id']]
-      sgSeqLrc = rev_compl(sgSeqL)
-      counts = lookupGuidePair[sgSeqLrc + sgSeqR]
-      out_ct.write('\t'.join([unique_pair_id, target_pair_id, gene_pair_id, str(counts)]) + '\n')
-      if counts == 0:
-        zero_guides += 1
-      if counts < 30:
-        less_30_guides += 1
-
-  total_guides = line_count
-
-  return total_guides, zero_guides, less_30_guides
-
-
-def write_stats(out_stats: str, col_names: List[str], values: List[str]):
+def sampled_read_pairs(sampler: FastqSampler, samples: List[DualGuideSampleCounts]):
+  '''
+  read pairs of the chunks of a sampler, the read pairs and counted read pairs of each chunk are kept in chunk_hits of
+  the samples as the read pairs are classified.
+  '''
+  for sample in samples:
+    sample.chunk_hits = []
+  for chunk in sampler.iter_chunks():
+    before = [(sample.n_reads, sample.get_counted_reads()) for sample in samples]
+    yield from chunk
+    for sample, (n_reads, n_counted) in zip(samples, before):
+      sample.chunk_hits.append((sample.n_reads - n_reads, sample.get_counted_reads() - n_counted))
+
+
+def write_classified_reads(
+  fastq1: str, fastq2: str, out_reads: str, guide_lib: DualGuideLibrary, samples: List[DualGuideSampleCounts],
+  umi_regex=None, barcodes: Dict[str, int] = None, barcode_length: int = 0,
+  sample_reads: int = None, sample_fraction: float = None, prefetch_threads: int = 0, reads_shards: int = 0):
+  '''
+  classify and count the read pairs of R1 and R2 FastQ files. If sample_reads or sample_fraction is given, only chunks of
+  read pairs spread across the files are classified, and the fraction of the input they are is returned.
+  '''
+  if sample_reads or sample_fraction:
+    sampler = FastqSampler(fastq1, fastq2, sample_reads, sample_fraction)
+    with open_classified_reads(out_reads, reads_shards) as classified_reads:
+      classify_read_pairs(
+        guide_lib, sampled_read_pairs(sampler, samples), samples, umi_regex, barcodes, barcode_length, classified_reads)
+    return sampler.fraction
+
+  with open_plain_or_gzipped_file(fastq1, prefetch_threads) as fq1, open_plain_or_gzipped_file(
+    fastq2, prefetch_threads) as fq2, open_classified_reads(out_reads, reads_shards) as classified_reads:
+    classify_read_pairs(
+      guide_lib, fastq_read_pairs(fq1, fq2), samples, umi_regex, barcodes, barcode_length, classified_reads)
+  return None
+
+
+def open_classified_reads(out_reads: str, reads_shards: int = 0):
+  '''
+  output of classified reads: a text file in read order, or BGZF-compressed shard files with an index if reads_shards
+  is given.
+  '''
+  return ShardedReadsWriter(out_reads, reads_shards) if reads_shards else open(out_reads, 'w')
+
+
+def classify_read_pairs(
+  guide_lib: DualGuideLibrary, read_pairs: Iterable[Tuple[str, str, str]], samples: List[DualGuideSampleCounts],
+  umi_regex=None, barcodes: Dict[str, int] = None, barcode_length: int = 0, classified_reads: TextIO = None):
+  '''
+  classify read pairs and count them into the samples, classified reads are written if an output is given. If
+  barcodes are given, the leading bases of R1 are the sample barcode, they're removed before looking for the guide
+  and read pairs not matching any barcode are skipped.
+  '''
+
+  LEFT, RIGHT, SAFE = DualGuideLibrary.LEFT, DualGuideLibrary.RIGHT, DualGuideLibrary.SAFE
+  guide_index, guide_rc_index, guide_seqs, guide_flags = (
+    guide_lib.guide_index, guide_lib.guide_rc_index, guide_lib.guide_seqs, guide_lib.guide_flags)
+
+  # pairs are looked up by code in the dict inline, the library looks them up otherwise (low memory mode)
+  pair_lookup = guide_lib.pair_lookup
+  pair_index = guide_lib.pair_index
+
+  sample = samples[0]
+  write_reads = classified_reads is not None
+  n_found_without_umi, n_no_barcode = 0, 0
+  for header, r1, r2 in read_pairs:
+    read_id = header[1:-3]
+    if barcodes is not None:
+      sample_index = barcodes.get(r1[:barcode_length])
+      if sample_index is None:
+        n_no_barcode += 1
+        continue
+      sample = samples[sample_index]
+      r1 = r1[barcode_length:]
+    sample.n_reads += 1
+    # Read2 is looked up as a reverse complemented guide and Read1 as a guide as it is
+    guide2 = guide_rc_index.get(r2)
+    guide1 = guide_index.get(r1)
+    flags2 = guide_flags[guide2] if guide2 is not None else 0
+    flags1 = guide_flags[guide1] if guide1 is not None else 0
+    if not (flags2 & LEFT and flags1 & RIGHT):
+      pair = -1
+    elif pair_lookup is not None:
+      pair = pair_lookup.get(guide2 << 32 | guide1, -1)
+    else:
+      pair = pair_index(guide2, guide1)
+    # look for correctly paired reads:
+    # Reverse Complement (Read2) -> gRNA1 (left); Read1 -> gRNA2 (right)
+    if pair >= 0:
+      sample.pair_counts[pair] += 1
+      if sample.umi_counts is not None:
+        umi = get_umi_from_read_name(umi_regex, header[1:])
+        if umi is None:
+          n_found_without_umi += 1
+        else:
+          sample.umi_counts.add(pair, umi)
+      r2rc = guide_seqs[guide2]
+      label1 = 'safe' if flags2 & SAFE else 'gRNA1'
+      label1_safe: bool = label1 == 'safe'
+      label2 = 'safe' if flags1 & SAFE else 'gRNA2'
+      label2_safe: bool = label2 == 'safe'
+      # count number of occurrances
+      if not label1_safe and not label2_safe:
+        sample.n_grna1_grna2 += 1
+      elif not label1_safe and label2_safe:
+        sample.n_grna1_safe += 1
+      elif label1_safe and not label2_safe:
+        sample.n_safe_grna2 += 1
+      else:
+        sample.n_safe_safe += 1
+      if write_reads:
+        classified_reads.write('\t'.join(['FOUND', f'{label1}_{label2}', sample.name, read_id, r1, r2, f'{r2rc}{r1}']) + '\n')
+
+    # both guides found but they are incorrectly paired (most reads fall here)
+    elif flags2 & LEFT and flags1 & RIGHT:
+      sample.n_incorrect_pair += 1
+      if write_reads:
+        classified_reads.write('\t'.join(['MISS', 'gRNA1_gRNA2', sample.name, read_id, r1, r2, 'NA']) + '\n')
+    # both guides found but they are incorrectly paired and have wrong orientation
+    # few reads fall here
+    elif flags1 & LEFT and flags2 & RIGHT:
+      sample.n_incorrect_pair += 1
+      if write_reads:
+        classified_reads.write('\t'.join(['MISS', 'gRNA1_gRNA2', sample.name, read_id, r1, r2, 'NA']) + '\n')
+    # only found the left guide (with either correct or wrong orientation)
+    elif flags2 & LEFT or flags1 & LEFT:
+      sample.n_grna1 += 1
+      if write_reads:
+        classified_reads.write('\t'.join(['MISS', 'gRNA1_nothing', sample.name, read_id, r1, r2, 'NA']) + '\n')
+    # only found the right guide (with either correct or wrong orientation)
+    elif flags1 & RIGHT or flags2 & RIGHT:
+      sample.n_grna2 += 1
+      if write_reads:
+        classified_reads.write('\t'.join(['MISS', 'nothing_gRNA2', sample.name, read_id, r1, r2, 'NA']) + '\n')
+    # didn't match any guides
+    else:
+      sample.n_miss_miss += 1
+      if write_reads:
+        classified_reads.write('\t'.join(['MISS', 'nothing_nothing', sample.name, read_id, r1, r2, 'NA']) + '\n')
+
+  if n_found_without_umi:
+    print(warning_msg(f'No UMI found in {n_found_without_umi} correctly paired reads, they are not in deduplicated counts.'), flush=True)
+  if n_no_barcode:
+    print(warning_msg(f'{n_no_barcode} read pairs do not start with any of the sample barcodes, they are not counted.'), flush=True)
+
+
+def write_guide_counts(out_counts: str, guide_lib: DualGuideLibrary, samples: List[DualGuideSampleCounts]):
+  '''
+  write counts of library rows with a column per sample (followed by a deduplicated counts column per sample if UMIs are
+  counted).
+  '''
+  col_names = [sample.name for sample in samples]
+  count_arrays = [sample.pair_counts for sample in samples]
+  if samples[0].umi_counts is not None:
+    col_names.extend(f'{sample.name}.dedup' for sample in samples)
+    count_arrays.extend(sample.umi_counts.counts for sample in samples)
+  row_format = b'%s' + b'\t%d' * len(count_arrays) + b'\n'
+
+  with open(out_counts, 'wb') as out_ct:
+    out_ct.write(('\t'.join(['unique_id', 'target_id', 'gene_pair_id', *col_names]) + '\n').encode())
+    out_ct.writelines(
+      row_format % (labels, *[counts[pair] for counts in count_arrays])
+      for labels, pair in zip(guide_lib.iter_row_labels(), guide_lib.row_pairs))
+
+
+def write_stats(out_stats: str, col_names: List[str], rows: List[List[str]]):
 
   with open(out_stats, 'w', newline='') as stats_out:
     stats_out.write('\t'.join(col_names) + '\n')
-    stats_out.write('\t'.join(values) + '\n')
+    for values in rows:
+      stats_out.write('\t'.join(values) + '\n')
@@ -0,0 +1,136 @@
+'''
+Plasmid counts of a single guide library, from a plasmid count TSV file or compiled into a binary file once for all the
+samples sharing the plasmid.
+
+A compiled file holds the counts as little-endian int64 aligned with the guides of the library in counts output order,
+with the plasmid name and a fingerprint of the library it was compiled for:
+
+  magic (8 bytes), library fingerprint (SHA-256, 32 bytes), number of guides (uint64), name size (uint32), name (UTF-8),
+  padding to a multiple of 8 bytes, counts (int64 per guide)
+
+The counts are memory-mapped when loaded, so the file is shared between concurrent runs through the page cache, and the
+plasmid count column is written by iterating the counts along the guides.
+'''
+import hashlib
+import mmap
+import struct
+import sys
+from array import array
+from typing import Dict
+from .utils import CrisprReadCountsError, PLASMID_COUNT_HEADER
+
+COMPILED_PLASMID_MAGIC = b'CRCPLAS\x01'
+# fingerprint, number of guides, name size
+COMPILED_PLASMID_HEADER = struct.Struct('<32sQI')
+
+
+class PlasmidCounts:
+  '''
+  Plasmid counts aligned with the guides of a library, with the fingerprint of the library if read from a compiled file.
+  '''
+
+  def __init__(self, name: str, counts, fingerprint: bytes = None):
+    self.name = name
+    self.counts = counts
+    self.fingerprint = fingerprint
+
+  def as_dict(self, library) -> Dict[str, int]:
+    return dict(zip(library.guide_ids, self.counts))
+
+
+def get_library_fingerprint(library) -> bytes:
+  '''
+  SHA-256 of the guide IDs and sequences of a library in counts output order.
+  '''
+  sha = hashlib.sha256()
+  for sgrna_id, seq_index in zip(library.guide_ids, library.guide_seq_index):
+    sha.update(f'{sgrna_id}\t{library.seqs[seq_index]}\n'.encode())
+  return sha.digest()
+
+
+def is_compiled_plasmid_file(plasmid_file: str) -> bool:
+  with open(plasmid_file, 'rb') as f:
+    return f.read(len(COMPILED_PLASMID_MAGIC)) == COMPILED_PLASMID_MAGIC
+
+
+def read_plasmid_counts_tsv(plasmid_file: str, library) -> PlasmidCounts:
+  '''
+  plasmid counts of a plasmid count TSV file (sgRNA, gene and count columns with a header), guides of the library
+  missing from the file have a count of 0.
+  '''
+  plasmid = {}
+  plasmid_name = None
+  with open(plasmid_file, 'r') as f:
+    for line_number, line in enumerate(f, 1):
+      line_split = line.strip().split('\t')
+      if len(line_split) < 3:
+        raise CrisprReadCountsError(f'Plasmid count file line: {line_number} does not have 3 columns, or the file uses expected delimiter.')
+      if line_number == 1:
+        if PLASMID_COUNT_HEADER.match(line):
+          plasmid_name = line_split[2]
+        else:
+          raise CrisprReadCountsError('Plasmid count file does not have expected header.')
+      else:
+        sgrna_id, count = line_split[0], line_split[2]
+        if not count.isdecimal():
+          raise CrisprReadCountsError(f'Plasmid count is not a non-negative integer on line: {line_number}.')
+        plasmid[sgrna_id] = int(count)
+  if plasmid_name is None:
+    raise CrisprReadCountsError('Plasmid count file is empty.')
+
+  try:
+    counts = array('q', (plasmid.get(sgrna_id, 0) for sgrna_id in library.guide_ids))
+  except OverflowError:
+    raise CrisprReadCountsError('Plasmid count file has counts too large to be stored as 64-bit integers.')
+  return PlasmidCounts(plasmid_name, counts)
+
+
+def write_compiled_plasmid(plasmid: PlasmidCounts, library, out_file: str):
+  '''
+  write plasmid counts aligned with the guides of a library into a compiled plasmid count file for that library.
+  '''
+  if len(plasmid.counts) != len(library):
+    raise CrisprReadCountsError('Plasmid counts are not aligned with the guides of the library.')
+  name = plasmid.name.encode()
+  header = COMPILED_PLASMID_MAGIC + COMPILED_PLASMID_HEADER.pack(
+    get_library_fingerprint(library), len(plasmid.counts), len(name)) + name
+  counts = array('q', plasmid.counts)
+  if sys.byteorder != 'little':
+    counts.byteswap()
+  with open(out_file, 'wb') as f:
+    # padding for the counts to be aligned when memory-mapped
+    f.write(header + b'\0' * (-len(header) % counts.itemsize))
+    counts.tofile(f)
+
+
+def read_compiled_plasmid(plasmid_file: str, library) -> PlasmidCounts:
+  with open(plasmid_file, 'rb') as f:
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  header_size = len(COMPILED_PLASMID_MAGIC) + COMPILED_PLASMID_HEADER.size
+  if len(mapped) < header_size or mapped[:len(COMPILED_PLASMID_MAGIC)] != COMPILED_PLASMID_MAGIC:
+    raise CrisprReadCountsError(f'Not a compiled plasmid count file: {plasmid_file}')
+  fingerprint, n_guides, name_size = COMPILED_PLASMID_HEADER.unpack_from(mapped, len(COMPILED_PLASMID_MAGIC))
+  if n_guides != len(library) or fingerprint != get_library_fingerprint(library):
+    raise CrisprReadCountsError(
+      f'Compiled plasmid count file: {plasmid_file} was compiled for a different guide library, compile it again with this library.')
+  name = mapped[header_size:header_size + name_size].decode()
+  offset = header_size + name_size
+  offset += -offset % 8
+  if len(mapped) != offset + 8 * n_guides:
+    raise CrisprReadCountsError(f'Compiled plasmid count file is truncated or corrupted: {plasmid_file}')
+
+  if sys.byteorder == 'little':
+    counts = memoryview(mapped)[offset:].cast('q')
+  else:
+    counts = array('q', mapped[offset:])
+    counts.byteswap()
+  return PlasmidCounts(name, counts, fingerprint)
+
+
+def load_plasmid_counts(plasmid_file: str, library) -> PlasmidCounts:
+  '''
+  plasmid counts of a compiled plasmid count file or of a plasmid count TSV file.
+  '''
+  if is_compiled_plasmid_file(plasmid_file):
+    return read_compiled_plasmid(plasmid_file, library)
+  return read_plasmid_counts_tsv(plasmid_file, library)
@@ -0,0 +1,138 @@
+'''
+Input layer for high latency storage: files (local paths or http(s) URLs) are read as large byte ranges fetched
+concurrently ahead of the reader by a pool of threads, instead of one sequential stream.
+
+Fetched blocks are handed to the reader (e.g. the gzip decompressor) as slices of memoryviews, so data is only copied
+into the reader's buffer.
+'''
+import io
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+from .utils import CrisprReadCountsError
+
+PREFETCH_THREADS = 4
+PREFETCH_BLOCK_SIZE = 8 * 1024 * 1024
+# blocks being fetched or waiting to be read, per thread
+PREFETCH_BLOCKS_PER_THREAD = 2
+HTTP_TIMEOUT = 60
+# size of the whole file in a Content-Range header, as 'bytes 0-0/1234' or 'bytes */0' for an empty file
+CONTENT_RANGE_SIZE = re.compile(r'bytes (?:\d+-\d+|\*)/(\d+)$')
+
+
+def is_url(path: str) -> bool:
+  return urlparse(path).scheme in ('http', 'https')
+
+
+class LocalRangeFetcher:
+
+  def __init__(self, path: str):
+    self.path = path
+    self.fd = os.open(path, os.O_RDONLY)
+    self.size = os.fstat(self.fd).st_size
+
+  def fetch(self, offset: int, size: int) -> bytes:
+    # pread does not move a shared file position, so ranges can be read by many threads at once
+    return os.pread(self.fd, size, offset)
+
+  def close(self):
+    os.close(self.fd)
+
+
+class HttpRangeFetcher:
+  '''
+  Byte ranges of a http(s) URL. The size of the file is taken from the Content-Range header of a first ranged GET, as
+  URLs presigned for GET (e.g. of object stores) are rejected for HEAD requests.
+  '''
+
+  def __init__(self, url: str):
+    self.url = url
+    try:
+      with urlopen(Request(url, headers={'Range': 'bytes=0-0'}), timeout=HTTP_TIMEOUT) as response:
+        if response.status != 206:
+          raise CrisprReadCountsError(f'Server does not support range requests for URL: {url}')
+        content_range = response.headers.get('Content-Range', '')
+    except HTTPError as e:
+      # a range starting beyond the end of an empty file is not satisfiable
+      if e.code != 416:
+        raise CrisprReadCountsError(f'Could not open URL: {url}, {e}')
+      content_range = e.headers.get('Content-Range', '')
+    except (URLError, OSError) as e:
+      raise CrisprReadCountsError(f'Could not open URL: {url}, {e}')
+    size_match = CONTENT_RANGE_SIZE.match(content_range.strip())
+    if size_match is None:
+      raise CrisprReadCountsError(f'Server did not provide the size of URL: {url}')
+    self.size = int(size_match.group(1))
+
+  def fetch(self, offset: int, size: int) -> bytes:
+    request = Request(self.url, headers={'Range': f'bytes={offset}-{offset + size - 1}'})
+    try:
+      with urlopen(request, timeout=HTTP_TIMEOUT) as response:
+        if response.status != 206:
+          raise CrisprReadCountsError(f'Server does not support range requests for URL: {self.url}')
+        return response.read()
+    except (URLError, OSError) as e:
+      raise CrisprReadCountsError(f'Could not read bytes {offset}-{offset + size - 1} of URL: {self.url}, {e}')
+
+  def close(self):
+    pass
+
+
+class PrefetchingReader(io.RawIOBase):
+  '''
+  Raw binary reader of a local file or a http(s) URL, fetching the next blocks of the file with a pool of threads.
+  '''
+
+  def __init__(self, path: str, threads: int = PREFETCH_THREADS, block_size: int = PREFETCH_BLOCK_SIZE):
+    super().__init__()
+    self.block_size = block_size
+    self.read_ahead = max(1, threads) * PREFETCH_BLOCKS_PER_THREAD
+    self.executor = ThreadPoolExecutor(max(1, threads))
+    self.pending = deque()
+    self.next_offset = 0
+    self.block = memoryview(b'')
+    self.block_pos = 0
+    self.fetcher = None
+    self.fetcher = HttpRangeFetcher(path) if is_url(path) else LocalRangeFetcher(path)
+
+  def readable(self) -> bool:
+    return True
+
+  def schedule(self):
+    while len(self.pending) < self.read_ahead and self.next_offset < self.fetcher.size:
+      size = min(self.block_size, self.fetcher.size - self.next_offset)
+      self.pending.append((size, self.executor.submit(self.fetcher.fetch, self.next_offset, size)))
+      self.next_offset += size
+
+  def readinto(self, buffer) -> int:
+    if self.block_pos >= len(self.block):
+      self.schedule()
+      if not self.pending:
+        return 0
+      size, future = self.pending.popleft()
+      self.block = memoryview(future.result())
+      self.block_pos = 0
+      if len(self.block) != size:
+        raise CrisprReadCountsError(f'Expected {size} bytes but got {len(self.block)} when reading file: {self.name}')
+      self.schedule()
+    n_bytes = min(len(buffer), len(self.block) - self.block_pos)
+    buffer[:n_bytes] = self.block[self.block_pos:self.block_pos + n_bytes]
+    self.block_pos += n_bytes
+    return n_bytes
+
+  @property
+  def name(self) -> str:
+    return getattr(self.fetcher, 'url', None) or self.fetcher.path
+
+  def close(self):
+    if not self.closed:
+      for _, future in self.pending:
+        future.cancel()
+      self.executor.shutdown(wait=True)
+      if self.fetcher is not None:
+        self.fetcher.close()
+    super().close()
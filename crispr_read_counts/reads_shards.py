@@ -0,0 +1,149 @@
+'''
+Writing of classified reads into many BGZF-compressed shard files in parallel.
+
+Reads are written by chunks, chunks going round robin to the shards. Each shard is compressed and written by its own
+thread: a chunk is cut into BGZF blocks, each compressed by zlib (raw deflate), and CPython releases the GIL while
+deflating, computing CRC32 and writing, so the shards are compressed on as many CPUs as there are shards.
+
+Each chunk starts a new BGZF block, so the byte range of a chunk in its shard is a valid BGZF file by itself:
+concatenating (e.g. with cat) the byte ranges listed in the index file in order gives a BGZF file of the reads in their
+original order, and concatenating whole shard files gives one with all reads.
+'''
+import os
+import struct
+import zlib
+from queue import Queue
+from threading import Thread
+from typing import List
+from .utils import CrisprReadCountsError
+
+SHARD_CHUNK_READS = 50000
+# uncompressed data of a BGZF block, as htslib: small enough for the compressed block to fit in 64 KiB
+BGZF_BLOCK_DATA_SIZE = 0xff00
+# gzip header with the BC extra field holding the block size minus 1
+BGZF_BLOCK_HEADER = struct.Struct('<4sIBBHBBHH')
+BGZF_BLOCK_FOOTER = struct.Struct('<II')
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# chunks waiting to be compressed per shard, the writing thread waits for the shards beyond it
+SHARD_QUEUE_SIZE = 2
+SHARDS_INDEX_HEADER = ['shard', 'offset', 'size', 'reads']
+
+
+def get_shard_paths(out_reads: str, n_shards: int) -> List[str]:
+  width = len(str(n_shards - 1))
+  return [f'{out_reads}.{shard:0{width}d}.gz' for shard in range(n_shards)]
+
+
+def get_shards_index_path(out_reads: str) -> str:
+  return f'{out_reads}.index.tsv'
+
+
+def compress_bgzf_blocks(data: bytes, level: int = zlib.Z_DEFAULT_COMPRESSION) -> bytes:
+  '''
+  data compressed as a series of BGZF blocks, a valid BGZF file once followed by the end of file block.
+  '''
+  blocks = []
+  for start in range(0, len(data), BGZF_BLOCK_DATA_SIZE):
+    block_data = data[start:start + BGZF_BLOCK_DATA_SIZE]
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(block_data) + compressor.flush()
+    block_size = BGZF_BLOCK_HEADER.size + len(deflated) + BGZF_BLOCK_FOOTER.size
+    blocks.append(BGZF_BLOCK_HEADER.pack(b'\x1f\x8b\x08\x04', 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size - 1))
+    blocks.append(deflated)
+    blocks.append(BGZF_BLOCK_FOOTER.pack(zlib.crc32(block_data), len(block_data)))
+  return b''.join(blocks)
+
+
+class ReadsShard:
+  '''
+  A shard file with its compressing and writing thread.
+  '''
+
+  def __init__(self, path: str, chunks: List[List]):
+    self.path = path
+    self.chunks = chunks
+    self.queue = Queue(SHARD_QUEUE_SIZE)
+    self.error = None
+    self.f = open(path, 'wb')
+    self.thread = Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        break
+      if self.error is not None:
+        # keep taking chunks for the writing thread not to wait forever, the error is raised by it
+        continue
+      chunk_index, lines = item
+      try:
+        offset = self.f.tell()
+        self.f.write(compress_bgzf_blocks(''.join(lines).encode()))
+        self.chunks[chunk_index][1:3] = [offset, self.f.tell() - offset]
+      except Exception as e:
+        self.error = e
+    try:
+      with self.f:
+        self.f.write(BGZF_EOF)
+    except Exception as e:
+      self.error = self.error or e
+
+
+class ShardedReadsWriter:
+  '''
+  Text output of classified reads, written into n_shards BGZF-compressed files by chunks of chunk_reads lines, with an
+  index file of the chunks in the order they were written: shard file name, offset and size of the chunk in the shard,
+  and number of reads.
+  '''
+
+  def __init__(self, out_reads: str, n_shards: int, chunk_reads: int = SHARD_CHUNK_READS):
+    self.out_reads = out_reads
+    self.chunk_reads = chunk_reads
+    self.lines = []
+    # [shard index, offset, size, reads] of each chunk
+    self.chunks = []
+    self.shards = []
+    self.closed = False
+    for path in get_shard_paths(out_reads, n_shards):
+      self.shards.append(ReadsShard(path, self.chunks))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def write(self, line: str):
+    self.lines.append(line)
+    if len(self.lines) >= self.chunk_reads:
+      self.flush_chunk()
+
+  def flush_chunk(self):
+    if not self.lines:
+      return
+    shard_index = len(self.chunks) % len(self.shards)
+    shard = self.shards[shard_index]
+    if shard.error is not None:
+      raise CrisprReadCountsError(f'Failed to write classified reads file: {shard.path}, {shard.error}')
+    self.chunks.append([shard_index, None, None, len(self.lines)])
+    shard.queue.put((len(self.chunks) - 1, self.lines))
+    self.lines = []
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    self.flush_chunk()
+    for shard in self.shards:
+      shard.queue.put(None)
+    for shard in self.shards:
+      shard.thread.join()
+    for shard in self.shards:
+      if shard.error is not None:
+        raise CrisprReadCountsError(f'Failed to write classified reads file: {shard.path}, {shard.error}')
+
+    with open(get_shards_index_path(self.out_reads), 'w') as f:
+      f.write('\t'.join(SHARDS_INDEX_HEADER) + '\n')
+      for shard_index, offset, size, n_reads in self.chunks:
+        f.write(f'{os.path.basename(self.shards[shard_index].path)}\t{offset}\t{size}\t{n_reads}\n')
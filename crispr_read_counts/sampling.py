@@ -0,0 +1,624 @@
+'''
+Sampling of reads spread across an input file, for estimating stats of a full run in a fraction of its time.
+
+CRAM files are sampled by whole containers: container headers are scanned (without decoding any data), evenly spaced
+containers are copied with the file header into a small temporary CRAM file, which is then counted as usual.
+FastQ files are sampled by chunks of records read from evenly spaced offsets, which requires a BGZF-compressed or an
+uncompressed file as a plain gzip stream can not be read from the middle.
+'''
+import math
+import os
+import random
+import statistics
+import struct
+import tempfile
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, Tuple, Dict, Iterable
+from .utils import CrisprReadCountsError, warning_msg
+from .prefetch import is_url
+
+SAMPLE_CHUNK_READS = 10000
+# FastQ samples are read in at least this many chunks to spread them across the file
+MIN_SAMPLE_CHUNKS = 20
+# how far (in bytes) before the proportional offset in R2 the mate of the first R1 read of a chunk is looked for
+PAIR_SYNC_MARGIN = 4 * 1024 * 1024
+Z_95 = 1.959963984540054
+# fitting of the distribution of guide abundances for estimating full depth stats
+ABUNDANCE_GRID_SIZE = 60
+MIN_GRID_ABUNDANCE = 0.05
+EM_ITERATIONS = 300
+BOOTSTRAP_ITERATIONS = 20
+BOOTSTRAP_EM_ITERATIONS = 50
+# full depth numbers of low count guides are only estimated from large enough samples: a guide at the low count
+# threshold must be expected to have this many sampled reads
+MIN_SAMPLED_READS_AT_THRESHOLD = 5
+# binomial draws of larger means use the normal approximation
+MAX_EXACT_BINOMIAL_MEAN = 30
+
+CRAM_FILE_DEFINITION_SIZE = 26
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_HEADER_SIZE = 18
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def check_sampling_options(sample_reads: int = None, sample_fraction: float = None):
+  if sample_reads is not None and sample_fraction is not None:
+    raise CrisprReadCountsError('Options "--sample-reads" and "--sample-fraction" can not be used together.')
+  if sample_reads is not None and sample_reads < 1:
+    raise CrisprReadCountsError('Number of reads to sample must be a positive integer.')
+  if sample_fraction is not None and not 0 < sample_fraction <= 1:
+    raise CrisprReadCountsError('Fraction of reads to sample must be greater than 0 and not greater than 1.')
+
+
+def get_target_reads(sample_reads: int, sample_fraction: float, total_reads: float) -> float:
+  return sample_reads if sample_reads else sample_fraction * total_reads
+
+
+def get_spaced_indexes(n_items: int, n_chunks: int) -> List[int]:
+  if n_chunks >= n_items:
+    return list(range(n_items))
+  return [int((index + 0.5) * n_items / n_chunks) for index in range(n_chunks)]
+
+
+# CRAM
+
+def read_itf8(buf: bytes, pos: int) -> Tuple[int, int]:
+  b0 = buf[pos]
+  if b0 < 0x80:
+    return b0, pos + 1
+  if b0 < 0xC0:
+    return ((b0 & 0x3F) << 8) | buf[pos + 1], pos + 2
+  if b0 < 0xE0:
+    return ((b0 & 0x1F) << 16) | (buf[pos + 1] << 8) | buf[pos + 2], pos + 3
+  if b0 < 0xF0:
+    return ((b0 & 0x0F) << 24) | (buf[pos + 1] << 16) | (buf[pos + 2] << 8) | buf[pos + 3], pos + 4
+  return ((b0 & 0x0F) << 28) | (buf[pos + 1] << 20) | (buf[pos + 2] << 12) | (buf[pos + 3] << 4) | (buf[pos + 4] & 0x0F), pos + 5
+
+
+def read_ltf8(buf: bytes, pos: int) -> Tuple[int, int]:
+  b0 = buf[pos]
+  n_bytes = 0
+  while n_bytes < 8 and b0 & (0x80 >> n_bytes):
+    n_bytes += 1
+  if n_bytes == 8:
+    return int.from_bytes(buf[pos + 1:pos + 9], 'big'), pos + 9
+  value = b0 & (0xFF >> (n_bytes + 1))
+  for index in range(n_bytes):
+    value = (value << 8) | buf[pos + 1 + index]
+  return value, pos + 1 + n_bytes
+
+
+def get_cram_containers(cram_file) -> List[Tuple[int, int, int]]:
+  '''
+  (offset, size, number of records) of each container of an opened CRAM file, the first one is the file header and
+  the last one the end of file container.
+  '''
+  header = cram_file.read(CRAM_FILE_DEFINITION_SIZE)
+  if header[:4] != b'CRAM':
+    raise CrisprReadCountsError('Input file is not a CRAM file.')
+  major_version = header[4]
+  file_size = cram_file.seek(0, os.SEEK_END)
+
+  containers = []
+  offset = CRAM_FILE_DEFINITION_SIZE
+  while offset < file_size:
+    cram_file.seek(offset)
+    buf = cram_file.read(128)
+    length = struct.unpack('<i', buf[:4])[0]
+    pos = 4
+    for _ in range(3):  # reference id, start and span
+      _, pos = read_itf8(buf, pos)
+    n_records, pos = read_itf8(buf, pos)
+    if major_version >= 3:
+      _, pos = read_ltf8(buf, pos)  # record counter
+      _, pos = read_ltf8(buf, pos)  # bases
+    else:
+      _, pos = read_itf8(buf, pos)
+      _, pos = read_ltf8(buf, pos)
+    _, pos = read_itf8(buf, pos)  # number of blocks
+    n_landmarks, pos = read_itf8(buf, pos)
+    for _ in range(n_landmarks):
+      _, pos = read_itf8(buf, pos)
+    if major_version >= 3:
+      pos += 4  # CRC32
+    containers.append((offset, pos + length, n_records))
+    offset += pos + length
+
+  if len(containers) < 2:
+    raise CrisprReadCountsError('Input CRAM file has no containers, truncated file?')
+  return containers
+
+
+@contextmanager
+def sampled_cram(in_file: str, sample_reads: int = None, sample_fraction: float = None):
+  '''
+  context of a temporary CRAM file of evenly spaced containers of the input, yields the path of the file, the fraction
+  of the input records in it and the numbers of records of its containers.
+  '''
+  with open(in_file, 'rb') as f:
+    containers = get_cram_containers(f)
+    file_header, data_containers, eof = containers[0], containers[1:-1], containers[-1]
+    data_containers = [container for container in data_containers if container[2] > 0]
+    total_records = sum(container[2] for container in data_containers)
+    if not data_containers:
+      raise CrisprReadCountsError('Input CRAM file has no reads.')
+
+    target_reads = get_target_reads(sample_reads, sample_fraction, total_records)
+    n_chunks = max(1, math.ceil(target_reads * len(data_containers) / total_records))
+    selected = [data_containers[index] for index in get_spaced_indexes(len(data_containers), n_chunks)]
+
+    with tempfile.NamedTemporaryFile(suffix='.cram') as sample_file:
+      f.seek(0)
+      sample_file.write(f.read(CRAM_FILE_DEFINITION_SIZE))
+      for offset, size, _ in [file_header, *selected, eof]:
+        f.seek(offset)
+        sample_file.write(f.read(size))
+      sample_file.flush()
+      chunk_records = [container[2] for container in selected]
+      yield sample_file.name, sum(chunk_records) / total_records, chunk_records
+
+
+# FastQ
+
+def is_bgzf(header: bytes) -> bool:
+  return header[:4] == BGZF_MAGIC and header[12:14] == b'BC'
+
+
+class SeekableFastq:
+  '''
+  A FastQ file which can be read from any offset: an uncompressed file, or a BGZF-compressed file of which reading
+  starts from the first block after the offset.
+  '''
+
+  def __init__(self, fastq: str):
+    if is_url(fastq):
+      raise CrisprReadCountsError(f'Sampling requires local FastQ files: {fastq}')
+    self.path = fastq
+    self.f = open(fastq, 'rb')
+    self.size = self.f.seek(0, os.SEEK_END)
+    self.f.seek(0)
+    header = self.f.read(BGZF_HEADER_SIZE)
+    self.bgzf = is_bgzf(header)
+    # bytes of the file decoded and the lines they hold, for estimating the size of a record
+    self.bytes_decoded = 0
+    self.lines_decoded = 0
+    if not self.bgzf and header[:2] == GZIP_MAGIC:
+      self.f.close()
+      raise CrisprReadCountsError(f'Sampling requires BGZF-compressed (e.g. by bgzip) or uncompressed FastQ files: {fastq}')
+
+  def close(self):
+    self.f.close()
+
+  def find_bgzf_block(self, offset: int) -> int:
+    '''
+    offset of the first BGZF block at or after an offset.
+    '''
+    while offset < self.size:
+      self.f.seek(offset)
+      buf = self.f.read(65536 + BGZF_HEADER_SIZE)
+      pos = buf.find(BGZF_MAGIC)
+      while pos >= 0 and pos + BGZF_HEADER_SIZE <= len(buf):
+        if is_bgzf(buf[pos:]):
+          return offset + pos
+        pos = buf.find(BGZF_MAGIC, pos + 1)
+      offset += 65536
+    return self.size
+
+  def read_blocks(self, offset: int):
+    '''
+    (end offset, uncompressed data) of the blocks from a block offset.
+    '''
+    while offset < self.size:
+      self.f.seek(offset)
+      header = self.f.read(BGZF_HEADER_SIZE)
+      if not is_bgzf(header):
+        raise CrisprReadCountsError(f'Invalid BGZF block at offset {offset} of file: {self.path}')
+      block_size = struct.unpack('<H', header[16:18])[0] + 1
+      data = zlib.decompress(self.f.read(block_size - BGZF_HEADER_SIZE), -15)
+      offset += block_size
+      yield offset, data
+
+  def read_lines(self, offset: int):
+    '''
+    (offset after the data read so far, line) from an offset, the first line is dropped if it may be partial.
+    '''
+    partial = offset > 0
+    if self.bgzf:
+      offset = self.find_bgzf_block(offset)
+      blocks = self.read_blocks(offset)
+    else:
+      self.f.seek(offset)
+      blocks = ((self.f.tell(), data) for data in iter(lambda: self.f.read(65536), b''))
+    remainder = b''
+    start = offset
+    for end, data in blocks:
+      self.bytes_decoded += end - start
+      self.lines_decoded += data.count(b'\n')
+      start = end
+      lines = (remainder + data).split(b'\n')
+      remainder = lines.pop()
+      for line in lines:
+        if partial:
+          partial = False
+          continue
+        yield end, line.decode()
+    if remainder and not partial:
+      yield self.size, remainder.decode()
+
+  def iter_records(self, offset: int):
+    '''
+    (offset after the data read so far, header, sequence) of the records from the first complete record after an offset.
+    '''
+    lines = []
+    synced = offset == 0
+    for position, line in self.read_lines(offset):
+      lines.append(line)
+      # wait for 5 lines to make sure lines[0] is a header, a quality line may start with a "@" too
+      if len(lines) < 5:
+        continue
+      if not synced:
+        if not (lines[0].startswith('@') and lines[2].startswith('+') and lines[4].startswith('@')):
+          lines.pop(0)
+          continue
+        synced = True
+      yield position, lines[0][1:], lines[1]
+      del lines[:4]
+    if len(lines) >= 2 and lines[0].startswith('@'):
+      yield self.size, lines[0][1:], lines[1]
+
+  def read_records(self, offset: int, n_records: int) -> Tuple[List[Tuple[str, str]], int]:
+    '''
+    up to n_records (header, sequence) records from the first complete record after an offset. Returns the records and
+    the offset of the end of the data read.
+    '''
+    records = []
+    position = offset
+    for position, header, seq in self.iter_records(offset):
+      records.append((header, seq))
+      if len(records) >= n_records:
+        break
+    return records, position
+
+  def get_record_size(self) -> float:
+    '''
+    average size of a record in the file (compressed if BGZF), from the data decoded so far.
+    '''
+    return self.bytes_decoded * 4 / self.lines_decoded if self.lines_decoded else self.size
+
+
+def get_read_name(header: str) -> str:
+  return header.split()[0].split('/')[0] if header else header
+
+
+class FastqSampler:
+  '''
+  Iterable of reads sampled by chunks of records at evenly spaced offsets of a FastQ file, or of a pair of FastQ files.
+  The fraction of the file(s) read is available once all reads are iterated.
+
+  Reads are (sequence, header) for a single file as from fastq_reads, and (R1 header line, R1 sequence, R2 sequence)
+  for a pair as from fastq_read_pairs. They can also be iterated as lists of the reads of each chunk.
+  '''
+
+  def __init__(self, fastq1: str, fastq2: str = None, sample_reads: int = None, sample_fraction: float = None):
+    self.fastq1 = fastq1
+    self.fastq2 = fastq2
+    self.sample_reads = sample_reads
+    self.sample_fraction = sample_fraction
+    self.fraction = None
+    self.n_unsynced_chunks = 0
+
+  def __iter__(self):
+    for chunk in self.iter_chunks():
+      yield from chunk
+
+  def iter_chunks(self):
+    fq1 = SeekableFastq(self.fastq1)
+    fq2 = SeekableFastq(self.fastq2) if self.fastq2 else None
+    try:
+      yield from self.sample(fq1, fq2)
+    finally:
+      fq1.close()
+      if fq2:
+        fq2.close()
+    if self.n_unsynced_chunks:
+      print(warning_msg(f'Could not find the mates of {self.n_unsynced_chunks} sampled chunks of reads in R2, they are skipped.'), flush=True)
+
+  def sample(self, fq1: SeekableFastq, fq2: SeekableFastq):
+    # the size of records is estimated from the first chunk to know how many chunks make the required fraction
+    fq1.read_records(0, SAMPLE_CHUNK_READS)
+    estimated_reads = fq1.size / fq1.get_record_size()
+    target_reads = get_target_reads(self.sample_reads, self.sample_fraction, estimated_reads)
+    if target_reads >= estimated_reads:
+      # all reads are read in one chunk
+      offsets, chunk_reads = [0], math.inf
+    else:
+      n_chunks = max(MIN_SAMPLE_CHUNKS, math.ceil(target_reads / SAMPLE_CHUNK_READS))
+      chunk_reads = max(1, math.ceil(target_reads / n_chunks))
+      offsets = [int(index * fq1.size / n_chunks) for index in range(n_chunks)]
+
+    n_sampled, read_end, fq1_records = 0, 0, None
+    for offset in offsets:
+      # a chunk starting within the data already read by the previous chunk continues from it, not to sample reads twice
+      if fq1_records is None or offset > read_end:
+        fq1_records = fq1.iter_records(offset)
+      records = []
+      for read_end, header, seq in fq1_records:
+        records.append((header, seq))
+        if len(records) >= chunk_reads:
+          break
+      if not records:
+        continue
+      if fq2 is None:
+        n_sampled += len(records)
+        yield [(seq, header) for header, seq in records]
+        continue
+
+      mates = self.find_mates(fq2, records, offset / fq1.size)
+      if mates is None:
+        self.n_unsynced_chunks += 1
+        continue
+      n_sampled += len(records)
+      yield [(f'@{header}\n', seq1, seq2) for (header, seq1), (_, seq2) in zip(records, mates)]
+
+    # sampled reads over the number of reads in the file estimated from the size of the records decoded
+    self.fraction = min(1.0, n_sampled * fq1.get_record_size() / fq1.size) if fq1.size else 1.0
+
+  @staticmethod
+  def find_mates(fq2: SeekableFastq, records: List[Tuple[str, str]], relative_offset: float):
+    '''
+    records of R2 with the same read names as the given R1 records. The first mate is looked for around the proportional
+    offset in R2, in windows growing up to PAIR_SYNC_MARGIN, None if it can't be found.
+    '''
+    first_name = get_read_name(records[0][0])
+    expected = int(relative_offset * fq2.size)
+    margin = 65536
+    while True:
+      start = max(0, expected - margin)
+      candidates = fq2.iter_records(start)
+      for position, header, seq in candidates:
+        if get_read_name(header) == first_name:
+          mates = [(header, seq)]
+          for _, header, seq in candidates:
+            if len(mates) == len(records):
+              break
+            mates.append((header, seq))
+          if len(mates) == len(records) and all(
+            get_read_name(mate[0]) == get_read_name(record[0]) for mate, record in zip(mates, records)
+          ):
+            return mates
+          return None
+        if position > expected + margin:
+          break
+      if margin >= PAIR_SYNC_MARGIN or (start == 0 and expected + margin >= fq2.size):
+        return None
+      margin = min(4 * margin, PAIR_SYNC_MARGIN)
+
+
+# estimation of full depth stats
+
+def wilson_interval(successes: float, trials: float) -> Tuple[float, float]:
+  if trials == 0:
+    return 0.0, 1.0
+  p = successes / trials
+  denominator = 1 + Z_95 ** 2 / trials
+  center = (p + Z_95 ** 2 / (2 * trials)) / denominator
+  half_width = Z_95 * math.sqrt(p * (1 - p) / trials + Z_95 ** 2 / (4 * trials ** 2)) / denominator
+  return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def chunked_hit_rate_interval(chunk_hits: List[Tuple[int, int]]) -> Tuple[float, float]:
+  '''
+  interval of the hit rate of reads sampled by chunks of (reads, hits). Reads of a chunk are not independent (e.g. the
+  hit rate varies along a run), so the Wilson interval is taken on the effective number of reads: the number of reads
+  over the design effect, the ratio of the variance between chunks to the variance of independent reads.
+  '''
+  n_reads = sum(reads for reads, _ in chunk_hits)
+  n_hits = sum(hits for _, hits in chunk_hits)
+  chunk_hits = [(reads, hits) for reads, hits in chunk_hits if reads]
+  if not n_reads or len(chunk_hits) < 2 or n_hits in (0, n_reads):
+    return wilson_interval(n_hits, n_reads)
+  hit_rate = n_hits / n_reads
+  # linearized variance of the ratio estimator
+  variance = len(chunk_hits) / (len(chunk_hits) - 1) * sum(
+    (hits - hit_rate * reads) ** 2 for reads, hits in chunk_hits) / n_reads ** 2
+  design_effect = max(1.0, variance / (hit_rate * (1 - hit_rate) / n_reads))
+  return wilson_interval(n_hits / design_effect, n_reads / design_effect)
+
+
+def get_abundance_grid(threshold: int, fraction: float) -> List[float]:
+  '''
+  full depth abundances the distribution of guide abundances is fitted on: 0 and log spaced values up to an abundance
+  sampled well above the threshold, higher abundances are all alike as their sampled counts are censored.
+  '''
+  top = (threshold + 5 * math.sqrt(threshold) + 5) / fraction
+  return [0.0] + [
+    MIN_GRID_ABUNDANCE * (top / MIN_GRID_ABUNDANCE) ** (index / (ABUNDANCE_GRID_SIZE - 2))
+    for index in range(ABUNDANCE_GRID_SIZE - 1)]
+
+
+def get_censored_likelihoods(grid: List[float], fraction: float, threshold: int) -> List[List[float]]:
+  '''
+  probabilities of each sampled count below the threshold, and of a count not below it (the last one), for each abundance
+  of the grid.
+  '''
+  likelihoods = [[0.0] * len(grid) for _ in range(threshold + 1)]
+  for index, abundance in enumerate(grid):
+    mean = fraction * abundance
+    pmf, cdf = math.exp(-mean), 0.0
+    for count in range(threshold):
+      likelihoods[count][index] = pmf
+      cdf += pmf
+      pmf *= mean / (count + 1)
+    likelihoods[threshold][index] = max(0.0, 1.0 - cdf)
+  return likelihoods
+
+
+def fit_abundance_distribution(
+  count_hist: Dict[int, int], likelihoods: List[List[float]], weights: List[float], n_iterations: int
+) -> List[float]:
+  '''
+  weights of the abundance grid maximizing the likelihood of the (censored) sampled counts (EM of the nonparametric
+  maximum likelihood estimate), from initial weights.
+  '''
+  n_guides = sum(count_hist.values())
+  for _ in range(n_iterations):
+    new_weights = [0.0] * len(weights)
+    for count, n_count in count_hist.items():
+      likelihood = likelihoods[count]
+      density = sum(weight * value for weight, value in zip(weights, likelihood))
+      if density == 0:
+        continue
+      scale = n_count / density
+      new_weights = [new_weight + value * scale for new_weight, value in zip(new_weights, likelihood)]
+    weights = [weight * new_weight / n_guides for weight, new_weight in zip(weights, new_weights)]
+  return weights
+
+
+def probability_below_threshold(
+  count: int, likelihood: List[float], weights: List[float], grid: List[float], fraction: float, threshold: int
+) -> float:
+  '''
+  probability of the full depth count of a guide being below the threshold, given its sampled count: the unsampled
+  reads are Poisson, averaged over the posterior of the guide abundance.
+  '''
+  if count >= threshold:
+    return 0.0
+  posterior = [weight * value for weight, value in zip(weights, likelihood)]
+  total = sum(posterior)
+  if total == 0:
+    return 0.0
+  prob_below = 0.0
+  for probability, abundance in zip(posterior, grid):
+    unsampled_mean = (1 - fraction) * abundance
+    pmf = math.exp(-unsampled_mean)
+    for unsampled in range(threshold - count):
+      prob_below += probability * pmf
+      pmf *= unsampled_mean / (unsampled + 1)
+  return min(1.0, prob_below / total)
+
+
+def estimate_guides_below_threshold(
+  count_hist: Dict[int, int], likelihoods: List[List[float]], weights: List[float], grid: List[float],
+  fraction: float, threshold: int
+) -> Tuple[float, float]:
+  '''
+  expected number of guides with a full depth count below the threshold, and its variance.
+  '''
+  mean = var = 0.0
+  for count, n_count in count_hist.items():
+    prob_low = probability_below_threshold(count, likelihoods[count], weights, grid, fraction, threshold)
+    mean += n_count * prob_low
+    var += n_count * prob_low * (1 - prob_low)
+  return mean, var
+
+
+def binomial_variate(rng: random.Random, n: int, p: float) -> int:
+  '''
+  a binomial draw: exact (by inversion) for a small mean, normal approximation otherwise.
+  '''
+  if p >= 1:
+    return n
+  if p > 0.5:
+    return n - binomial_variate(rng, n, 1 - p)
+  if n * p > MAX_EXACT_BINOMIAL_MEAN:
+    return min(n, max(0, round(rng.gauss(n * p, math.sqrt(n * p * (1 - p))))))
+  u = rng.random()
+  k, pmf = 0, (1 - p) ** n
+  cdf = pmf
+  while u > cdf and k < n:
+    pmf *= (n - k) / (k + 1) * p / (1 - p)
+    k += 1
+    cdf += pmf
+  return k
+
+
+def resample_histogram(rng: random.Random, count_hist: Dict[int, int]) -> Dict[int, int]:
+  '''
+  bootstrap resample of the guides of a count histogram: a multinomial draw of as many guides, by conditional binomials.
+  '''
+  n_left = n_total = sum(count_hist.values())
+  resample = {}
+  for count, n_count in count_hist.items():
+    if n_left == 0:
+      break
+    resample[count] = binomial_variate(rng, n_left, n_count / n_total) if n_total > n_count else n_left
+    n_left -= resample[count]
+    n_total -= n_count
+  return resample
+
+
+def estimate_full_depth_stats(
+  counts: Iterable[int], sampled_reads: int, mapped_reads: int, fraction: float, low_threshold: int,
+  zero_key: str = 'zero_guides', low_key: str = 'low_guides', chunk_hits: List[Tuple[int, int]] = None
+) -> Dict[str, float]:
+  '''
+  extrapolate stats of sampled reads to the full input, with 95% confidence intervals.
+
+  The hit rate interval accounts for the reads being sampled by chunks of (reads, hits) if chunk_hits is given.
+
+  Too few sampled reads do not tell guides below a count from guides a little above it, whatever the model. A guide with
+  no sampled read may have none or a few reads at full depth, so the number of zero count guides is only bounded, from 0
+  to the number of guides with a sampled count of 0 (the estimate is None unless all reads are sampled). The number of
+  low count guides is bounded the same way (up to the guides sampled below the threshold), and estimated when a guide at
+  the threshold is expected to have MIN_SAMPLED_READS_AT_THRESHOLD sampled reads: the full depth count of each guide is
+  modelled as its sampled count plus Poisson unsampled reads, the distribution of guide abundances being estimated from
+  the sampled counts, censored at the threshold (a discrete distribution on a grid, fitted by EM). The estimate is the
+  sum of the per guide probabilities of being below the threshold, its interval is normal, from the variance of the sum
+  plus the variance of refitting the distribution on bootstrap resamples of the guides.
+  '''
+  fraction = min(max(fraction, 1e-12), 1.0)
+  hit_rate = mapped_reads / sampled_reads if sampled_reads else 0.0
+  hit_rate_low, hit_rate_high = (
+    chunked_hit_rate_interval(chunk_hits) if chunk_hits and fraction < 1 else wilson_interval(mapped_reads, sampled_reads))
+  estimates = {
+    'sampled_reads': sampled_reads,
+    'sampling_fraction': round(fraction, 6),
+    'estimated_total_reads': round(sampled_reads / fraction),
+    'hit_rate': round(hit_rate, 4),
+    'hit_rate_ci_low': round(hit_rate_low, 4),
+    'hit_rate_ci_high': round(hit_rate_high, 4),
+  }
+
+  # sampled counts not below the threshold are censored, these guides can not be low count guides
+  count_hist = Counter(min(count, low_threshold) for count in counts)
+  n_guides = sum(count_hist.values())
+  n_sampled_zero = count_hist[0]
+  n_sampled_low = n_guides - count_hist[low_threshold]
+
+  low_value = None
+  if fraction == 1 or not n_sampled_low:
+    # nothing to estimate, sampled counts are the full depth counts or all guides are above the threshold
+    low_value, low_var = n_sampled_low, 0.0
+  elif fraction * low_threshold >= MIN_SAMPLED_READS_AT_THRESHOLD:
+    grid = get_abundance_grid(low_threshold, fraction)
+    likelihoods = get_censored_likelihoods(grid, fraction, low_threshold)
+    weights = fit_abundance_distribution(count_hist, likelihoods, [1 / len(grid)] * len(grid), EM_ITERATIONS)
+    low_value, low_var = estimate_guides_below_threshold(count_hist, likelihoods, weights, grid, fraction, low_threshold)
+
+    # the fitted distribution is uncertain too, it is refitted (from the fit) on bootstrap resamples of the guides
+    rng = random.Random(0)
+    bootstrap_low = []
+    for _ in range(BOOTSTRAP_ITERATIONS):
+      resample_hist = resample_histogram(rng, count_hist)
+      resample_weights = fit_abundance_distribution(resample_hist, likelihoods, weights, BOOTSTRAP_EM_ITERATIONS)
+      bootstrap_low.append(estimate_guides_below_threshold(
+        resample_hist, likelihoods, resample_weights, grid, fraction, low_threshold)[0])
+    low_var += statistics.variance(bootstrap_low)
+
+  # a guide with a sampled read is not a zero count guide
+  zero_known = fraction == 1 or not n_sampled_zero
+  estimates[f'estimated_{zero_key}'] = n_sampled_zero if zero_known else None
+  estimates[f'estimated_{zero_key}_ci_low'] = n_sampled_zero if zero_known else 0
+  estimates[f'estimated_{zero_key}_ci_high'] = n_sampled_zero
+  if low_value is None:
+    estimates[f'estimated_{low_key}'] = None
+    estimates[f'estimated_{low_key}_ci_low'] = 0
+    estimates[f'estimated_{low_key}_ci_high'] = n_sampled_low
+  else:
+    half_width = Z_95 * math.sqrt(low_var)
+    estimates[f'estimated_{low_key}'] = round(low_value)
+    estimates[f'estimated_{low_key}_ci_low'] = max(0, math.floor(low_value - half_width))
+    estimates[f'estimated_{low_key}_ci_high'] = min(n_sampled_low, math.ceil(low_value + half_width))
+  return estimates
@@ -1,15 +1,30 @@
 import sys
-from typing import Dict, Any
+from array import array
+from itertools import islice
+from typing import Dict, Any, List, Iterable, Callable, Tuple
 from .utils import (
   error_msg,
+  warning_msg,
   open_plain_or_gzipped_file,
   rev_compl,
-  PLASMID_COUNT_HEADER,
+  get_umi_from_read_name,
+  CrisprReadCountsError,
   DNA_PATTERN,
+  UmiCounts,
+  SpaceSavingCounter,
   check_file_readable,
   check_file_writable)
+from .sampling import check_sampling_options, sampled_cram, FastqSampler, estimate_full_depth_stats
+from .plasmid import load_plasmid_counts, read_plasmid_counts_tsv, write_compiled_plasmid
 import pysam
 import json
+import re
+
+LOW_COUNT_GUIDES_THRESHOLD = 15
+DIAGNOSTICS_READ_INTERVAL = 100
+DIAGNOSTICS_TOP_UNMATCHED = 20
+# the sketch counts many more sequences than reported for the reported counts to be accurate
+DIAGNOSTICS_SKETCH_CAPACITY = 50 * DIAGNOSTICS_TOP_UNMATCHED
 
 
 def count_single(args: Dict[str, Any]):
@@ -18,8 +33,44 @@ def count_single(args: Dict[str, Any]):
   # delimiter length should be 1, or should it?
   if len(args['lib_delimiter']) != 1:
     sys.exit(error_msg('Supplied delimiter length must be 1.'))
-  count_instance = SingleGuideReadCounts(args['library'], args['lib_delimiter'], args['input'], args['output'], args['ref'])
-  count_instance.count(args['trim'], args['plasmid'], args['reverse_complement'], args['stats'])
+  umi_tag, umi_regex = args.get('umi_tag'), args.get('umi_regex')
+  if umi_tag and umi_regex:
+    sys.exit(error_msg('Options "--umi-tag" and "--umi-regex" can not be used together.'))
+  if umi_regex:
+    try:
+      umi_regex = re.compile(umi_regex)
+    except re.error as e:
+      sys.exit(error_msg(f'Invalid UMI regular expression: {e}'))
+  sample_reads, sample_fraction = args.get('sample_reads'), args.get('sample_fraction')
+  diagnostics_interval = args.get('diagnostics_interval', DIAGNOSTICS_READ_INTERVAL)
+  if diagnostics_interval < 1:
+    sys.exit(error_msg('Diagnostics read interval must be a positive integer.'))
+  try:
+    check_sampling_options(sample_reads, sample_fraction)
+    count_instance = SingleGuideReadCounts(args['library'], args['lib_delimiter'], args['input'], args['output'], args['ref'])
+    diagnostics = None
+    if args.get('diagnostics'):
+      diagnostics = SingleGuideDiagnostics(count_instance.library, args['trim'], args['reverse_complement'], diagnostics_interval)
+    count_instance.count(
+      args['trim'], args['plasmid'], args['reverse_complement'], args['stats'], umi_tag, umi_regex, sample_reads, sample_fraction,
+      diagnostics)
+    if diagnostics:
+      diagnostics.write(args['diagnostics'])
+  except CrisprReadCountsError as e:
+    sys.exit(error_msg(str(e)))
+
+
+def compile_plasmid(args: Dict[str, Any]):
+  check_file_readable(args['library'], 'Provided library file does not exist or have no permission to read: %s' % args['library'])
+  check_file_readable(args['plasmid'], 'Provided plasmid count file does not exist or have no permission to read: %s' % args['plasmid'])
+  check_file_writable(args['output'], 'Cannot write to provided output compiled plasmid file: %s' % args['output'])
+  if len(args['lib_delimiter']) != 1:
+    sys.exit(error_msg('Supplied delimiter length must be 1.'))
+  try:
+    library = SingleGuideLibrary.from_file(args['library'], args['lib_delimiter'])
+    write_compiled_plasmid(read_plasmid_counts_tsv(args['plasmid'], library), library, args['output'])
+  except CrisprReadCountsError as e:
+    sys.exit(error_msg(str(e)))
 
 
 def check_files(args: Dict[str, Any]):
@@ -33,172 +84,426 @@ def check_files(args: Dict[str, Any]):
   check_file_writable(args['output'], 'Cannot write to provided output count file: %s' % args['output'])
   if args['stats']:
     check_file_writable(args['stats'], 'Cannot write to provided output stats file: %s' % args['stats'])
+  if args.get('diagnostics'):
+    check_file_writable(args['diagnostics'], 'Cannot write to provided output diagnostics file: %s' % args['diagnostics'])
 
 
-class SingleGuideReadCounts:
+class SingleGuideLibrary:
   '''
-  The class is just to reduce parameters passing around functions.
+  A single guide library, loaded once and reusable for counting any number of samples.
+
+  Guides are kept in the order of the counts output: sorted by sequence, guides sharing a sequence in library file order.
+  Reads are counted per distinct sequence and the counts are spread to the guides of the sequence at the end.
   '''
 
-  LOW_COUNT_GUIDES_THRESHOLD = 15
+  def __init__(self, lib: Dict[str, List[str]], targeted_genes: Dict[str, str]):
+    self.lib = lib
+    self.targeted_genes = targeted_genes
+    self.seqs = sorted(lib.keys())
+    # reads are sliced to the length of the first sequence of the library file, library sequences are assumed to be of
+    # the same length
+    self.lib_seq_size = len(next(iter(lib))) if lib else 0
+    self.guide_ids = [sgrna_id for seq in self.seqs for sgrna_id in lib[seq]]
+    self.guide_seq_index = array('L', (index for index, seq in enumerate(self.seqs) for _ in lib[seq]))
 
-  def __init__(self, library, lib_delimiter, in_file, out_count, ref):
-    self.lib, self.targeted_genes = self.get_single_guide_library(library, lib_delimiter)
-    self.in_file = in_file
-    self.out_count = out_count
-    self.ref = ref  # ref must be an existing file if input is a CRAM
-    self.plasmid = None
-    self.plas_name = None
-    self.sample_count = {}
-    self.sample_name = None
-    self.stats = {}
+  def __len__(self):
+    return len(self.guide_ids)
 
-  def open_cram_and_get_sample_name(self):
-    if not self.ref:
-      sys.exit(error_msg(f'Reference file must be provided for reading a CRAM file.'))
-    try:
-      samfile = pysam.AlignmentFile(self.in_file, "rc", reference_filename=self.ref)
-    except Exception as e:
-      sys.exit(error_msg('Unexpected exception when trying to open input CRAM file: %s' % str(e)))
+  @classmethod
+  def from_file(cls, lib_file: str, delimiter: str = '\t'):
+    lib = {}
+    targeted_genes = {}
+
+    with open(lib_file, 'r') as f:
+      for line_number, line in enumerate(f, 1):
+        line_split = line.strip().split(delimiter)
+        if len(line_split) < 3:
+          raise CrisprReadCountsError(f'Guide RNA library file line: {line_number} does not have 3 columns, or the file uses expected delimiter.')
+        sgrna_id, gene_name, lib_seq = line_split[0], line_split[1], line_split[2]
+        if not DNA_PATTERN.match(lib_seq):
+          raise CrisprReadCountsError(f'Sequence column contains non-DNA characters on line: {line_number}.')
 
-    for rg in samfile.header.to_dict().get('RG'):  # does not matter which RG line's SM tag is used
-      self.sample_name = rg.get('SM')
-    if not self.sample_name:
-      sys.exit(error_msg('Could not find "SM" tag in the input file header'))
-    return samfile
+        if lib_seq in lib:
+          lib[lib_seq].append(sgrna_id)
+        else:
+          lib[lib_seq] = [sgrna_id]
 
-  def get_lib_seq_dict_and_seq_length(self, reverse_complementing):
+        targeted_genes[sgrna_id] = gene_name
+
+    return cls(lib, targeted_genes)
+
+  def get_lib_seq_dict_and_seq_length(self, reverse_complementing: bool):
+    '''
+    dict of library sequences (reverse complemented if required) to their index, and the library sequence length.
+    '''
     lib_seqs = {}
-    for seq in self.lib.keys():
+    for index, seq in enumerate(self.seqs):
       key = seq
       if reverse_complementing:
         # reverse complementing guide RNA sequences instead of each read
         key = rev_compl(key)
-      lib_seqs[key] = seq
-
-    # assume library sequences are in same length
-    for seq in lib_seqs.keys():
-      lib_seq_size = len(seq)
-      break
+      lib_seqs[key] = index
 
-    return lib_seqs, lib_seq_size
+    return lib_seqs, self.lib_seq_size
 
-  def get_sgrna_library_counts(self, trim: int, reverse_complementing: bool):
+  def count(self, reads: Iterable, trim: int = 0, reverse_complement: bool = False,
+            get_umi: Callable = None, sample_name: str = None,
+            diagnostics: 'SingleGuideDiagnostics' = None, chunked: bool = False) -> 'SingleGuideCounts':
     '''
+    count an iterable of read sequences.
+
+    If get_umi is given, reads are (sequence, record) tuples and get_umi(record) returns the UMI of a read (or None), it is
+    only called for reads matching a guide. Reads are then also counted once per (guide, UMI).
+    If diagnostics is given, it is also fed a subsample of the reads.
+    If chunked, reads is an iterable of chunks of reads (e.g. sampled chunks), the numbers of reads and of mapped reads of
+    each chunk are kept in chunk_hits of the result.
     # NOTE: Stats are calculated regardless whether they're required or not in order to achieve better code maintainability.
     # From limited benchmarking runs, this only increase ~2% run time with 11 million reads as input.
     '''
-    total_reads, vendor_failed_reads, mapped_to_guide_reads = 0, 0, 0
+    total_reads, mapped_to_guide_reads, reads_without_umi = 0, 0, 0
+    seq_counts = array('L', [0]) * len(self.seqs)
+    umi_counts = UmiCounts(len(self.seqs)) if get_umi else None
 
-    samfile = self.open_cram_and_get_sample_name()
-    lib_seqs, lib_seq_size = self.get_lib_seq_dict_and_seq_length(reverse_complementing)
-    sl = self.get_seq_slicing_indexes(reverse_complementing, trim, lib_seq_size)
+    lib_seqs, lib_seq_size = self.get_lib_seq_dict_and_seq_length(reverse_complement)
+    sl = SingleGuideReadCounts.get_seq_slicing_indexes(reverse_complement, trim, lib_seq_size)
 
-    for read in samfile.fetch(until_eof=True):
-      # if the alignment is secondary or supplymentary, skip it!
-      if read.flag & 2304:
-        continue
+    chunk_hits = []
+    for chunk in reads if chunked else [reads]:
+      if diagnostics is not None:
+        chunk = diagnostics.tap(chunk, get_umi is not None)
+      chunk_reads, chunk_mapped_reads, chunk_reads_without_umi = count_reads(
+        chunk, lib_seqs, sl, seq_counts, umi_counts, get_umi)
+      total_reads += chunk_reads
+      mapped_to_guide_reads += chunk_mapped_reads
+      reads_without_umi += chunk_reads_without_umi
+      chunk_hits.append((chunk_reads, chunk_mapped_reads))
 
-      # if the alignment is vendor failed, skip it but count it!
-      if read.flag & 512:
-        total_reads += 1
-        vendor_failed_reads += 1
-        continue
+    stats = {'total_reads': total_reads, 'vendor_failed_reads': 0, 'mapped_to_guide_reads': mapped_to_guide_reads}
+    dedup_counts = None
+    if umi_counts is not None:
+      dedup_counts = array('L', (umi_counts.counts[index] for index in self.guide_seq_index))
+      stats['deduplicated_mapped_to_guide_reads'] = len(umi_counts.seen)
+      stats['mapped_reads_without_umi'] = reads_without_umi
 
-      total_reads += 1
-      cram_seq = read.get_forward_sequence()[sl]
+    return SingleGuideCounts(
+      self, sample_name, array('L', (seq_counts[index] for index in self.guide_seq_index)), stats, dedup_counts,
+      chunk_hits if chunked else None, umi_counts.seen if umi_counts is not None else None)
+
+  def count_cram(self, in_file: str, ref: str, trim: int = 0, reverse_complement: bool = False,
+                 umi_tag: str = None, umi_regex=None, sample_reads: int = None,
+                 sample_fraction: float = None, diagnostics: 'SingleGuideDiagnostics' = None,
+                 chunk_records: List[int] = None) -> 'SingleGuideCounts':
+    '''
+    count primary reads of a CRAM file, the sample name is taken from the SM tag of the file header. Vendor failed
+    reads are not counted but are included in total reads. If chunk_records is given, the file is counted by chunks of
+    that many consecutive records.
+
+    If sample_reads or sample_fraction is given, only evenly spaced containers of about that many reads are counted and
+    stats of the full file are estimated.
+    '''
+    if sample_reads or sample_fraction:
+      with sampled_cram(in_file, sample_reads, sample_fraction) as (sample_file, fraction, chunk_records):
+        result = self.count_cram(
+          sample_file, ref, trim, reverse_complement, umi_tag, umi_regex, diagnostics=diagnostics,
+          chunk_records=chunk_records)
+      result.add_full_depth_estimates(fraction)
+      return result
+
+    samfile, sample_name = open_cram_and_get_sample_name(in_file, ref)
+    vendor_failed_reads = 0
+
+    def cram_reads(records):
+      nonlocal vendor_failed_reads
+      for read in records:
+        # if the alignment is secondary or supplymentary, skip it!
+        if read.flag & 2304:
+          continue
+        # if the alignment is vendor failed, skip it but count it!
+        if read.flag & 512:
+          vendor_failed_reads += 1
+          continue
+        if get_umi:
+          yield read.get_forward_sequence(), read
+        else:
+          yield read.get_forward_sequence()
+
+    get_umi = None
+    if umi_tag or umi_regex:
+      umi_regex = re.compile(umi_regex) if umi_regex else None
+
+      def get_umi(read):
+        if umi_regex:
+          return get_umi_from_read_name(umi_regex, read.query_name)
+        return read.get_tag(umi_tag) if read.has_tag(umi_tag) else None
+
+    with samfile:
+      records = samfile.fetch(until_eof=True)
+      if chunk_records:
+        # chunks of consecutive records, the reads of a chunk are consumed before the next chunk is started
+        chunks = (cram_reads(islice(records, n_records)) for n_records in chunk_records)
+        result = self.count(chunks, trim, reverse_complement, get_umi, sample_name, diagnostics, chunked=True)
+      else:
+        result = self.count(cram_reads(records), trim, reverse_complement, get_umi, sample_name, diagnostics)
+    result.stats['total_reads'] += vendor_failed_reads
+    result.stats['vendor_failed_reads'] = vendor_failed_reads
+    return result
+
+  def count_fastq(self, fastq: str, sample_name: str, trim: int = 0, reverse_complement: bool = False,
+                  umi_regex=None, sample_reads: int = None, sample_fraction: float = None,
+                  diagnostics: 'SingleGuideDiagnostics' = None, prefetch_threads: int = 0) -> 'SingleGuideCounts':
+    '''
+    count reads of a (gzipped) FastQ file, UMIs are looked for in the read header lines if umi_regex is given. The file
+    may be a http(s) URL, it is read with prefetch_threads threads (or a default number of threads) fetching byte ranges
+    ahead.
+
+    If sample_reads or sample_fraction is given, only chunks of reads spread across the file are counted and stats of
+    the full file are estimated, the file must then be BGZF-compressed or uncompressed.
+    '''
+    get_umi = None
+    if umi_regex:
+      umi_regex = re.compile(umi_regex)
+
+      def get_umi(header):
+        return get_umi_from_read_name(umi_regex, header)
+
+    if sample_reads or sample_fraction:
+      sampler = FastqSampler(fastq, None, sample_reads, sample_fraction)
+      chunks = sampler.iter_chunks() if get_umi else ([seq for seq, _ in chunk] for chunk in sampler.iter_chunks())
+      result = self.count(chunks, trim, reverse_complement, get_umi, sample_name, diagnostics, chunked=True)
+      result.add_full_depth_estimates(sampler.fraction)
+      return result
+
+    with open_plain_or_gzipped_file(fastq, prefetch_threads) as f:
+      return self.count(
+        fastq_reads(f, get_umi is not None), trim, reverse_complement, get_umi, sample_name, diagnostics)
+
+
+class SingleGuideCounts:
+  '''
+  Read counts of a sample, aligned with the guides of its library, with the stats of the counting.
+  '''
+
+  def __init__(self, library: SingleGuideLibrary, sample_name: str, counts, stats: Dict[str, int], dedup_counts=None,
+               chunk_hits: List[Tuple[int, int]] = None, umi_keys: set = None):
+    self.library = library
+    self.sample_name = sample_name
+    self.counts = counts
+    self.dedup_counts = dedup_counts
+    # (reads, mapped reads) of each chunk, when reads were counted by chunks
+    self.chunk_hits = chunk_hits
+    # (library sequence index, UMI) keys of UmiCounts seen, for deduplicated counts to be merged
+    self.umi_keys = umi_keys
+    self.stats = stats
+    self.stats['zero_count_guides'] = self.counts.count(0)
+    self.stats['low_count_guides'] = sum(1 for count in self.counts if count < LOW_COUNT_GUIDES_THRESHOLD)
+
+  def as_dict(self) -> Dict[str, int]:
+    return dict(zip(self.library.guide_ids, self.counts))
+
+  def add_full_depth_estimates(self, fraction: float):
+    '''
+    add stats estimated for the full input to the stats of counts of a sampled fraction of it.
+    '''
+    self.stats.update(estimate_full_depth_stats(
+      self.counts, self.stats['total_reads'], self.stats['mapped_to_guide_reads'], fraction,
+      LOW_COUNT_GUIDES_THRESHOLD, 'zero_count_guides', 'low_count_guides', self.chunk_hits))
+
+
+class SingleGuideDiagnostics:
+  '''
+  Diagnostics of low hit rates, collected from every interval-th read while counting.
+
+  Each diagnosed read is looked up in the library at every trim offset it allows, in both orientations, to find the
+  configuration matching the most reads. Sequences of the diagnosed reads not matching a guide in the configuration used
+  for counting are counted in a Space-Saving sketch, for a table of the most frequent unmatched sequences.
+  '''
+
+  def __init__(self, library: SingleGuideLibrary, trim: int = 0, reverse_complement: bool = False,
+               interval: int = DIAGNOSTICS_READ_INTERVAL, top_unmatched: int = DIAGNOSTICS_TOP_UNMATCHED):
+    self.trim = trim
+    self.reverse_complement = reverse_complement
+    self.interval = interval
+    self.top_unmatched = top_unmatched
+    self.lib_seqs, self.lib_seq_size = library.get_lib_seq_dict_and_seq_length(False)
+    self.lib_rc_seqs, _ = library.get_lib_seq_dict_and_seq_length(True)
+    self.n_reads = 0
+    # mapped reads of each trim offset, forward and reverse complement
+    self.mapped_reads = {False: [], True: []}
+    self.unmatched = SpaceSavingCounter(max(DIAGNOSTICS_SKETCH_CAPACITY, 50 * top_unmatched))
+
+  def tap(self, reads: Iterable, with_record: bool = False):
+    '''
+    pass reads through, diagnosing every interval-th read.
+    '''
+    interval = self.interval
+    for index, read in enumerate(reads):
+      if index % interval == 0:
+        self.add(read[0] if with_record else read)
+      yield read
+
+  def add(self, seq: str):
+    self.n_reads += 1
+    size = self.lib_seq_size
+    n_offsets = len(seq) - size + 1
+    for reverse_complement, lib_seqs in ((False, self.lib_seqs), (True, self.lib_rc_seqs)):
+      mapped_reads = self.mapped_reads[reverse_complement]
+      if len(mapped_reads) < n_offsets:
+        mapped_reads.extend([0] * (n_offsets - len(mapped_reads)))
+      for trim in range(n_offsets):
+        # same slices as get_seq_slicing_indexes
+        start = len(seq) - trim - size if reverse_complement else trim
+        if seq[start:start + size] in lib_seqs:
+          mapped_reads[trim] += 1
+
+    seq_slice = seq[SingleGuideReadCounts.get_seq_slicing_indexes(self.reverse_complement, self.trim, size)]
+    if seq_slice not in (self.lib_rc_seqs if self.reverse_complement else self.lib_seqs):
+      self.unmatched.add(seq_slice)
 
-      matching_lib_seq = lib_seqs.get(cram_seq)
-      if matching_lib_seq:
+  def get_mapped_reads(self, trim: int, reverse_complement: bool) -> int:
+    mapped_reads = self.mapped_reads[reverse_complement]
+    return mapped_reads[trim] if trim < len(mapped_reads) else 0
+
+  def get_results(self) -> Dict[str, Any]:
+    '''
+    diagnosed reads mapped to guides in each configuration (best first), and the most frequent unmatched sequences (as
+    in the reads) with their counts in the diagnosed reads and maximum overcounts.
+    '''
+    configurations = sorted((
+      {'trim': trim, 'reverse_complement': reverse_complement, 'mapped_to_guide_reads': mapped_reads}
+      for reverse_complement in (False, True) for trim, mapped_reads in enumerate(self.mapped_reads[reverse_complement])
+    ), key=lambda configuration: configuration['mapped_to_guide_reads'], reverse=True)
+    return {
+      'diagnosed_reads': self.n_reads,
+      'read_interval': self.interval,
+      'current_configuration': {
+        'trim': self.trim,
+        'reverse_complement': self.reverse_complement,
+        'mapped_to_guide_reads': self.get_mapped_reads(self.trim, self.reverse_complement)},
+      'best_configuration': configurations[0] if configurations else None,
+      'configurations': configurations,
+      'top_unmatched_sequences': [
+        {'sequence': seq, 'count': count, 'max_overcount': overcount}
+        for seq, count, overcount in self.unmatched.top(self.top_unmatched)],
+    }
+
+  def write(self, out_diagnostics: str):
+    results = self.get_results()
+    with open(out_diagnostics, 'w') as f:
+      json.dump(results, f, indent=2)
+      f.write('\n')
+    best, current = results['best_configuration'], results['current_configuration']
+    if best and best['mapped_to_guide_reads'] > current['mapped_to_guide_reads']:
+      print(warning_msg(
+        f'Diagnosed reads map to guides best with trim {best["trim"]} and reverse complement '
+        f'{"on" if best["reverse_complement"] else "off"} ({best["mapped_to_guide_reads"]} of {self.n_reads} reads, '
+        f'{current["mapped_to_guide_reads"]} with the options used).'), flush=True)
+
+
+def count_reads(reads: Iterable, lib_seqs: Dict[str, int], sl: slice, seq_counts, umi_counts: UmiCounts = None,
+                get_umi: Callable = None) -> Tuple[int, int, int]:
+  '''
+  add reads mapped to library sequences to the counts of the sequences (and UMI counts if given), returns the numbers
+  of reads, of mapped reads and of mapped reads without UMI.
+  '''
+  total_reads, mapped_to_guide_reads, reads_without_umi = 0, 0, 0
+  if umi_counts is None:
+    for seq in reads:
+      total_reads += 1
+      index = lib_seqs.get(seq[sl])
+      if index is not None:
+        mapped_to_guide_reads += 1
+        seq_counts[index] += 1
+  else:
+    for seq, record in reads:
+      total_reads += 1
+      index = lib_seqs.get(seq[sl])
+      if index is not None:
         mapped_to_guide_reads += 1
-        for grna_id in self.lib[matching_lib_seq]:
-          self.sample_count[grna_id] = self.sample_count.get(grna_id, 0) + 1
+        seq_counts[index] += 1
+        umi = get_umi(record)
+        if umi is None:
+          reads_without_umi += 1
+        else:
+          umi_counts.add(index, str(umi))
+  return total_reads, mapped_to_guide_reads, reads_without_umi
+
+
+def fastq_reads(fastq, with_header: bool = False):
+  '''
+  sequences of the reads in an opened FastQ file, or (sequence, header line) tuples if with_header.
+  '''
+  header = None
+  for line_index, line in enumerate(fastq, 1):
+    residue = line_index % 4
+    if residue == 1:
+      header = line[1:].rstrip('\n')
+    elif residue == 2:
+      yield (line.rstrip('\n'), header) if with_header else line.rstrip('\n')
+
+
+def open_cram_and_get_sample_name(in_file: str, ref: str):
+  if not ref:
+    raise CrisprReadCountsError('Reference file must be provided for reading a CRAM file.')
+  try:
+    samfile = pysam.AlignmentFile(in_file, "rc", reference_filename=ref)
+  except Exception as e:
+    raise CrisprReadCountsError('Unexpected exception when trying to open input CRAM file: %s' % str(e))
+
+  sample_name = None
+  for rg in samfile.header.to_dict().get('RG', []):  # does not matter which RG line's SM tag is used
+    sample_name = rg.get('SM')
+  if not sample_name:
+    samfile.close()
+    raise CrisprReadCountsError('Could not find "SM" tag in the input file header')
+  return samfile, sample_name
+
+
+class SingleGuideReadCounts:
+  '''
+  The class is just to reduce parameters passing around functions.
+  '''
 
-    self.stats['total_reads'] = total_reads
-    self.stats['vendor_failed_reads'] = vendor_failed_reads
-    self.stats['mapped_to_guide_reads'] = mapped_to_guide_reads
+  LOW_COUNT_GUIDES_THRESHOLD = LOW_COUNT_GUIDES_THRESHOLD
+
+  def __init__(self, library, lib_delimiter, in_file, out_count, ref):
+    self.library = SingleGuideLibrary.from_file(library, lib_delimiter)
+    self.in_file = in_file
+    self.out_count = out_count
+    self.ref = ref  # ref must be an existing file if input is a CRAM
+    self.plasmid = None
+    self.plas_name = None
+    self.result = None
 
   def write_output(self, out_stats: str):
-    zero_count_guides, low_count_guides = 0, 0
+    result, library = self.result, self.library
+    # deduplicated counts, when available, go in the last column so merging the output works as it is
+    dedup_header = [f'{result.sample_name}.sample.dedup'] if result.dedup_counts is not None else []
+    dedup_counts = [[str(count)] for count in result.dedup_counts] if result.dedup_counts is not None else [[]] * len(library)
     with open(self.out_count, 'w', newline='') as f:
       if self.plas_name:
-        f.write('\t'.join(['sgRNA', 'gene', f'{self.sample_name}.sample', self.plas_name]) + '\n')
-        for sgrna_seq in sorted(self.lib.keys()):
-          for sgrna_id in self.lib[sgrna_seq]:
-            count = self.sample_count.get(sgrna_id, 0)
-            if count == 0:
-              zero_count_guides += 1
-            if count < self.LOW_COUNT_GUIDES_THRESHOLD:
-              low_count_guides += 1
-            plasmid_count = self.plasmid.get(sgrna_id, 0)
-            f.write('\t'.join([sgrna_id, self.targeted_genes[sgrna_id], str(count), str(plasmid_count)]) + '\n')
+        f.write('\t'.join(['sgRNA', 'gene', f'{result.sample_name}.sample', self.plas_name, *dedup_header]) + '\n')
+        for sgrna_id, count, plasmid_count, dedup_count in zip(library.guide_ids, result.counts, self.plasmid.counts, dedup_counts):
+          f.write('\t'.join([sgrna_id, library.targeted_genes[sgrna_id], str(count), str(plasmid_count), *dedup_count]) + '\n')
       else:
-        f.write('\t'.join(['sgRNA', 'gene', f'{self.sample_name}.sample']) + '\n')
-        for sgrna_seq in sorted(self.lib.keys()):
-          for sgrna_id in self.lib[sgrna_seq]:
-            count = self.sample_count.get(sgrna_id, 0)
-            if count == 0:
-              zero_count_guides += 1
-            if count < self.LOW_COUNT_GUIDES_THRESHOLD:
-              low_count_guides += 1
-            f.write('\t'.join([sgrna_id, self.targeted_genes[sgrna_id], str(count)]) + '\n')
+        f.write('\t'.join(['sgRNA', 'gene', f'{result.sample_name}.sample', *dedup_header]) + '\n')
+        for sgrna_id, count, dedup_count in zip(library.guide_ids, result.counts, dedup_counts):
+          f.write('\t'.join([sgrna_id, library.targeted_genes[sgrna_id], str(count), *dedup_count]) + '\n')
 
     if out_stats:
-      self.stats['zero_count_guides'] = zero_count_guides
-      self.stats['low_count_guides'] = low_count_guides
       with open(out_stats, 'w') as out_s:
-        json.dump(self.stats, out_s)
+        json.dump(result.stats, out_s)
         out_s.write('\n')
 
-  def count(self, trim, plasmid_count_file, reverse_complement, out_stats):
+  def count(self, trim, plasmid_count_file, reverse_complement, out_stats, umi_tag=None, umi_regex=None,
+            sample_reads=None, sample_fraction=None, diagnostics=None):
     if plasmid_count_file:
-      self.plasmid, self.plas_name = self.get_plasmid_read_counts(plasmid_count_file)
-    self.get_sgrna_library_counts(trim, reverse_complement)
+      # a plasmid count TSV file or one compiled by compile-plasmid for this library
+      self.plasmid = load_plasmid_counts(plasmid_count_file, self.library)
+      self.plas_name = self.plasmid.name
+    self.result = self.library.count_cram(
+      self.in_file, self.ref, trim, reverse_complement, umi_tag, umi_regex, sample_reads, sample_fraction, diagnostics)
     self.write_output(out_stats)
 
-  @staticmethod
-  def get_single_guide_library(lib_file: str, delimiter: str):
-    lib = {}
-    targeted_genes = {}
-
-    with open(lib_file, 'r') as f:
-      for line_number, line in enumerate(f, 1):
-        line_split = line.strip().split(delimiter)
-        if len(line_split) < 3:
-          sys.exit(error_msg(f'Guide RNA library file line: {line_number} does not have 3 columns, or the file uses expected delimiter.'))
-        sgrna_id, gene_name, lib_seq = line_split[0], line_split[1], line_split[2]
-        if not DNA_PATTERN.match(lib_seq):
-          sys.exit(error_msg(f'Sequence column contains non-DNA characters on line: {line_number}.'))
-
-        if lib_seq in lib:
-          lib[lib_seq].append(sgrna_id)
-        else:
-          lib[lib_seq] = [sgrna_id]
-
-        targeted_genes[sgrna_id] = gene_name
-
-    return lib, targeted_genes
-
-  @staticmethod
-  def get_plasmid_read_counts(plasmid_file: str):
-    plasmid = {}
-    plasmid_name = None
-    with open(plasmid_file, 'r') as f:
-      for line_number, line in enumerate(f, 1):
-        line_split = line.strip().split('\t')
-        if len(line_split) < 3:
-          sys.exit(error_msg(f'Plasmid count file line: {line_number} does not have 3 columns, or the file uses expected delimiter.'))
-        if line_number == 1:
-          if PLASMID_COUNT_HEADER.match(line):
-            plasmid_name = line_split[2]
-          else:
-            sys.exit(error_msg(f'Plasmid count file does not have expected header.'))
-        else:
-          sgrna_id, count = line_split[0], line_split[2]
-          plasmid[sgrna_id] = count
-
-    return plasmid, plasmid_name
-
   @staticmethod
   def get_seq_slicing_indexes(reverse_complementing, trim, lib_seq_size):
     return (
@@ -5,9 +5,17 @@ from .utils import (
   open_plain_or_gzipped_file,
   check_file_readable,
   check_file_writable,
-  PLASMID_COUNT_HEADER)
+  warning_msg,
+  CrisprReadCountsError,
+  PLASMID_COUNT_HEADER,
+  UmiCounts)
+from array import array
+from operator import add
 from typing import TextIO, List, Dict
-from .single_guide_count import SingleGuideReadCounts
+from .single_guide_count import SingleGuideReadCounts, SingleGuideCounts
+
+READ_STATS_KEYS = ('total_reads', 'vendor_failed_reads', 'mapped_to_guide_reads')
+UMI_STATS_KEYS = ('deduplicated_mapped_to_guide_reads', 'mapped_reads_without_umi')
 
 
 def merge_single(args):
@@ -21,7 +29,13 @@ def merge_single(args):
   if args['stats']:
     check_file_writable(args['stats'], 'Cannot write to provided output stats file: %s' % args['stats'])
 
-  samp_name, plas_name, sample_rc, plasmid_rc, genes = get_sample_read_counts(files, has_plasmid)
+  try:
+    samp_name, plas_name, sample_rc, plasmid_rc, genes, with_dedup = get_sample_read_counts(files, has_plasmid)
+  except CrisprReadCountsError as e:
+    sys.exit(error_msg(str(e)))
+  if with_dedup:
+    # an UMI of a guide seen in several files would be counted once per file
+    print(warning_msg('Deduplicated counts can not be merged from count files, they are not in the merged counts.'), flush=True)
   print(f'writing merged counts to: {args["output"]}...', flush=True)
   with open(args['output'], 'w', newline='') as out:
     if has_plasmid:
@@ -40,8 +54,13 @@ def merge_single(args):
 
 
 def get_sample_read_counts(files: List[str], has_plasmid: bool):
+  '''
+  sample name, plasmid name, dicts of summed sample counts, plasmid counts and targeted genes of the count files, and
+  whether any file has deduplicated counts (which are not read).
+  '''
   sample_name, plasmid_name = None, None
   sample, plasmid, targeted_genes = {}, {}, {}
+  any_with_dedup = False
 
   for a_file in files:
     print(f'reading from {a_file}...')
@@ -50,44 +69,40 @@ def get_sample_read_counts(files: List[str], has_plasmid: bool):
       header_split = header.split('\t')
       if PLASMID_COUNT_HEADER.match(header):
         sample_name = header_split[2]
+        # deduplicated counts (count-single with UMIs) are the last column, named after the sample column
+        with_dedup = len(header_split) > 3 and header_split[-1] == f'{sample_name}.dedup'
+        any_with_dedup = any_with_dedup or with_dedup
         if has_plasmid:
-          if len(header_split) < 4:
-            sys.exit(error_msg(f'Can not find plasmid count column in input file: {a_file}.\nProbably should remove option "--plasmid"?'))
+          if len(header_split) - with_dedup < 4:
+            raise CrisprReadCountsError(f'Can not find plasmid count column in input file: {a_file}.\nProbably should remove option "--plasmid"?')
           if plasmid_name is None:
             plasmid_name = header_split[3]
           elif plasmid_name != header_split[3]:
             # files should have same plasmid sample name
-            sys.exit(error_msg(f'Plasmid sample names is different in this file: {a_file} from in file: {files[0]}'))
+            raise CrisprReadCountsError(f'Plasmid sample names is different in this file: {a_file} from in file: {files[0]}')
       else:
-        sys.exit(error_msg(f'Unexpected header in input file: {a_file}'))
+        raise CrisprReadCountsError(f'Unexpected header in input file: {a_file}')
 
       def get_counts_results(in_f: TextIO, with_or_without_plasmid_counts: bool):
         '''
         read a count file and update sample dict, targeted_genes dict and plasmid dict if plasmid counts are available.
         '''
-        if with_or_without_plasmid_counts:
-          for line in in_f:
-            line_split = line.strip().split('\t')
-            id = line_split[0]
-            sample_count = sample.get(id, 0) + int(line_split[2])
-            sample[id] = sample_count
-            targeted_genes[id] = line_split[1]
+        for line in in_f:
+          line_split = line.strip().split('\t')
+          id = line_split[0]
+          sample_count = sample.get(id, 0) + int(line_split[2])
+          sample[id] = sample_count
+          targeted_genes[id] = line_split[1]
+          if with_or_without_plasmid_counts:
             count = int(line_split[3])
             if id in plasmid and count != plasmid[id]:
-              sys.exit(error_msg(f'Plasmid count of sgRNA: {id} is not consistent across input count files.'))
+              raise CrisprReadCountsError(f'Plasmid count of sgRNA: {id} is not consistent across input count files.')
             else:
               plasmid[id] = count
-        else:
-          for line in in_f:
-            line_split = line.strip().split('\t')
-            id = line_split[0]
-            sample_count = sample.get(id, 0) + int(line_split[2])
-            sample[id] = sample_count
-            targeted_genes[id] = line_split[1]
 
       get_counts_results(in_f, has_plasmid)
 
-  return sample_name, plasmid_name, sample, plasmid, targeted_genes
+  return sample_name, plasmid_name, sample, plasmid, targeted_genes, any_with_dedup
 
 
 def write_stats_to_file(sample_count: Dict[str, int], output_path: str):
@@ -106,3 +121,42 @@ def write_stats_to_file(sample_count: Dict[str, int], output_path: str):
   with open(output_path, 'w') as out_s:
     json.dump(stats, out_s)
     out_s.write('\n')
+
+
+def merge_single_counts(results: List[SingleGuideCounts], sample_name: str = None) -> SingleGuideCounts:
+  '''
+  merge counts of samples counted with the same library, the merged sample takes the name of the last sample unless a
+  name is given. Stats of reads are summed up and guide stats are recalculated, estimates of the full input of sampled
+  counts are not additive and are dropped. Deduplicated counts are counted again from the union of the (guide, UMI)
+  pairs of the samples, if all samples have them.
+  '''
+  if not results:
+    raise CrisprReadCountsError('No counts to merge.')
+  library = results[0].library
+  if any(result.library is not library and result.library.guide_ids != library.guide_ids for result in results):
+    raise CrisprReadCountsError('Can not merge counts of different libraries.')
+  with_dedup = all(result.umi_keys is not None for result in results)
+
+  counts = array('L', [0]) * len(library)
+  # UMI stats are only kept if all samples have them
+  stats_keys = READ_STATS_KEYS + UMI_STATS_KEYS if with_dedup else READ_STATS_KEYS
+  stats = dict.fromkeys(stats_keys, 0)
+  # deduplicated reads are not additive
+  summed_keys = [key for key in stats_keys if key != 'deduplicated_mapped_to_guide_reads']
+  for result in results:
+    counts = array('L', map(add, counts, result.counts))
+    for key in summed_keys:
+      stats[key] += result.stats.get(key, 0)
+
+  dedup_counts = umi_keys = None
+  if with_dedup:
+    # a UMI of a guide seen in several samples is counted once
+    umi_keys = set().union(*(result.umi_keys for result in results))
+    seq_counts = array('L', [0]) * len(library.seqs)
+    for key in umi_keys:
+      seq_counts[key >> UmiCounts.UMI_BITS] += 1
+    dedup_counts = array('L', (seq_counts[index] for index in library.guide_seq_index))
+    stats['deduplicated_mapped_to_guide_reads'] = len(umi_keys)
+
+  return SingleGuideCounts(
+    library, sample_name or results[-1].sample_name, counts, stats, dedup_counts, umi_keys=umi_keys)
@@ -1,6 +1,11 @@
 import gzip
+import io
 import re
+from array import array
 from contextlib import contextmanager
+from heapq import heappush, heapreplace
+from typing import List, Tuple, Hashable
+from urllib.parse import urlparse
 import os
 import sys
 
@@ -15,6 +20,12 @@ def rev_compl(dna: str) -> str:
     return dna[::-1].translate(dna_complement_tr_table)
 
 
+class CrisprReadCountsError(Exception):
+  '''
+  Raised on invalid inputs, command line entry points turn it into an error message and exit.
+  '''
+
+
 def error_msg(msg: str):
   return f'#------\n# Error: {process_multiple_lines(msg)}\n#------'
 
@@ -32,9 +43,105 @@ def process_multiple_lines(msg):
   )
 
 
+def get_umi_from_read_name(umi_regex, read_name: str):
+  '''
+  UMI matched by the regex in the read name, the first group of the regex is used if it has one, None if no match.
+  '''
+  match = umi_regex.search(read_name)
+  if not match:
+    return None
+  return match.group(1) if umi_regex.groups else match.group(0)
+
+
+class UmiCounts:
+  '''
+  Counts distinct UMIs per integer index (e.g. a guide or a guide pair).
+
+  Each (index, UMI) combination seen is kept as a single integer in one set instead of one set of strings per index.
+  UMIs of up to 12 characters are packed into the integer as they are, so the set is exact for them. Longer UMIs are
+  represented by a 64 bit hash, of which collisions are negligible for the number of UMIs in a sample.
+  '''
+
+  UMI_BITS = 96
+  HASHED_UMI_FLAG = 1 << (UMI_BITS - 1)  # never set in a packed UMI as ASCII bytes are < 0x80
+
+  def __init__(self, size: int):
+    self.seen = set()
+    self.counts = array('L', [0]) * size
+
+  def add(self, index: int, umi: str) -> bool:
+    '''
+    record an UMI of an index, returns True if the UMI had not been seen for the index.
+    '''
+    umi_bytes = umi.encode()
+    if len(umi_bytes) <= self.UMI_BITS // 8:
+      key = index << self.UMI_BITS | int.from_bytes(umi_bytes, 'big')
+    else:
+      key = index << self.UMI_BITS | self.HASHED_UMI_FLAG | (hash(umi) & 0xFFFFFFFFFFFFFFFF)
+    if key in self.seen:
+      return False
+    self.seen.add(key)
+    self.counts[index] += 1
+    return True
+
+
+class SpaceSavingCounter:
+  '''
+  Approximate counts of the most frequent items of a stream in bounded memory (the Space-Saving algorithm).
+
+  At most capacity items are counted. A new item replaces the item of the lowest count and takes over its count, which
+  is kept as the maximum overcount of the new item. Any item seen more than total / capacity times is kept.
+  '''
+
+  def __init__(self, capacity: int):
+    self.capacity = capacity
+    self.total = 0
+    self.counts = {}
+    self.overcounts = {}
+    # (count, item) of each counted item, counts of incremented items are only updated when they reach the top
+    self.heap = []
+
+  def add(self, item: Hashable):
+    self.total += 1
+    counts = self.counts
+    if item in counts:
+      counts[item] += 1
+      return
+    if len(counts) < self.capacity:
+      counts[item] = 1
+      self.overcounts[item] = 0
+      heappush(self.heap, (1, item))
+      return
+
+    heap = self.heap
+    while counts[heap[0][1]] != heap[0][0]:
+      heapreplace(heap, (counts[heap[0][1]], heap[0][1]))
+    min_count, min_item = heap[0]
+    del counts[min_item], self.overcounts[min_item]
+    counts[item] = min_count + 1
+    self.overcounts[item] = min_count
+    heapreplace(heap, (min_count + 1, item))
+
+  def top(self, n: int) -> List[Tuple[Hashable, int, int]]:
+    '''
+    (item, count, maximum overcount) of the n items of the highest counts.
+    '''
+    items = sorted(self.counts.items(), key=lambda item_count: item_count[1], reverse=True)[:n]
+    return [(item, count, self.overcounts[item]) for item, count in items]
+
+
 @contextmanager
-def open_plain_or_gzipped_file(file: str):
-    if file.endswith('.gz'):
+def open_plain_or_gzipped_file(file: str, prefetch_threads: int = 0):
+    '''
+    open a (gzipped) text file. Files given as http(s) URLs, or any file if prefetch_threads is given, are read through
+    concurrent prefetching of large byte ranges.
+    '''
+    from .prefetch import PrefetchingReader, is_url, PREFETCH_THREADS
+    raw = None
+    if prefetch_threads or is_url(file):
+      raw = io.BufferedReader(PrefetchingReader(file, prefetch_threads or PREFETCH_THREADS))
+      f = gzip.open(raw, 'rt') if urlparse(file).path.endswith('.gz') else io.TextIOWrapper(raw)
+    elif file.endswith('.gz'):
       f = gzip.open(file, 'rt')
     else:
       f = open(file, 'r')
@@ -42,6 +149,8 @@ def open_plain_or_gzipped_file(file: str):
         yield f
     finally:
         f.close()
+        if raw is not None:
+          raw.close()
 
 
 def check_file_readable(fn, msg_if_fail=None):
@@ -1 +1 @@
-version = '2.1.0'
+version = '2.2.0'
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import pytest
+from crispr_read_counts.api import (
+  CrisprReadCountsError,
+  SingleGuideLibrary,
+  SingleGuideDiagnostics,
+  DualGuideLibrary,
+  merge_single_counts)
+from crispr_read_counts.utils import rev_compl
+
+test_single_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'test-single')
+test_dual_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'test-dual')
+
+
+def test_single_guide_library_count():
+  library = SingleGuideLibrary.from_file(os.path.join(test_single_data_dir, 'Human_v1_CRISPR_library.test.lib.csv'), ',')
+  reads = ['GACTTCCAGCTACGGCGCGAAAA', 'GACTTCCAGCTACGGCGCGTTTT', 'CTTCCAGCTACGGCGCGAAAAAA', 'TTTTTTTTTTTTTTTTTTTTTTT']
+  result = library.count(reads, sample_name='test')
+  counts = result.as_dict()
+  assert counts['A1BG_CCDS12976.1_ex3_19:58862927-58862950:-_5-1'] == 2
+  assert sum(result.counts) == 2
+  assert result.stats['total_reads'] == 4
+  assert result.stats['mapped_to_guide_reads'] == 2
+  assert result.stats['zero_count_guides'] == len(library) - 1
+
+  umi_result = library.count(
+    [(read, umi) for read, umi in zip(reads, ['AA', 'AA', 'CC', 'GG'])], get_umi=lambda umi: umi, sample_name='test')
+  assert umi_result.dedup_counts[library.guide_ids.index('A1BG_CCDS12976.1_ex3_19:58862927-58862950:-_5-1')] == 1
+  assert umi_result.stats['deduplicated_mapped_to_guide_reads'] == 1
+
+  merged = merge_single_counts([result, result])
+  assert merged.sample_name == 'test'
+  assert list(merged.counts) == [count * 2 for count in result.counts]
+  assert merged.stats['total_reads'] == 8
+  assert 'deduplicated_mapped_to_guide_reads' not in merge_single_counts([result, umi_result]).stats
+
+  # estimates of sampled counts are not summed
+  umi_result.add_full_depth_estimates(0.5)
+  merged = merge_single_counts([umi_result, umi_result])
+  assert set(merged.stats) == {
+    'total_reads', 'vendor_failed_reads', 'mapped_to_guide_reads', 'deduplicated_mapped_to_guide_reads',
+    'mapped_reads_without_umi', 'zero_count_guides', 'low_count_guides'}
+  # UMIs of a guide seen in both samples are counted once
+  assert merged.stats['deduplicated_mapped_to_guide_reads'] == 1
+  assert list(merged.dedup_counts) == list(umi_result.dedup_counts)
+  assert merged.stats['mapped_reads_without_umi'] == 0
+  other_result = library.count(
+    [(read, umi) for read, umi in zip(reads, ['CC', 'CC', 'CC', 'CC'])], get_umi=lambda umi: umi, sample_name='test')
+  merged = merge_single_counts([umi_result, other_result, merged])
+  assert merged.stats['deduplicated_mapped_to_guide_reads'] == 2
+  assert merged.dedup_counts[library.guide_ids.index('A1BG_CCDS12976.1_ex3_19:58862927-58862950:-_5-1')] == 2
+  assert sum(merged.dedup_counts) == 2
+
+
+def test_single_guide_library_mixed_lengths():
+  # reads are sliced to the length of the first library sequence in file order, not in sorted order
+  with tempfile.TemporaryDirectory() as tmpd:
+    lib_file = os.path.join(tmpd, 'library.tsv')
+    with open(lib_file, 'w') as f:
+      f.write('short\tGENE1\tTTTTCCCCGGGGAAAAC\n' + 'long\tGENE2\tAAAACCCCGGGGTTTTACGT\n')
+    library = SingleGuideLibrary.from_file(lib_file)
+  assert library.seqs[0] == 'AAAACCCCGGGGTTTTACGT'
+  assert library.get_lib_seq_dict_and_seq_length(False)[1] == 17
+  result = library.count(['TTTTCCCCGGGGAAAACGT', 'AAAACCCCGGGGTTTTACGT'])
+  assert result.as_dict() == {'long': 0, 'short': 1}
+
+
+def test_single_guide_diagnostics():
+  library = SingleGuideLibrary.from_file(os.path.join(test_single_data_dir, 'Human_v1_CRISPR_library.test.lib.csv'), ',')
+  guide = library.seqs[0]
+  # guides shifted by 2 bases, and an unmatched sequence
+  reads = ['AC' + guide + 'TTTT'] * 8 + ['G' * 26] * 2
+  diagnostics = SingleGuideDiagnostics(library, interval=1)
+  result = library.count(reads, diagnostics=diagnostics)
+  assert result.stats['mapped_to_guide_reads'] == 0
+  results = diagnostics.get_results()
+  assert results['diagnosed_reads'] == 10
+  assert results['current_configuration']['mapped_to_guide_reads'] == 0
+  assert results['best_configuration'] == {'trim': 2, 'reverse_complement': False, 'mapped_to_guide_reads': 8}
+  assert len(results['configurations']) == 2 * (26 - len(guide) + 1)
+  assert results['top_unmatched_sequences'][0] == {'sequence': 'AC' + guide[:-2], 'count': 8, 'max_overcount': 0}
+
+  diagnostics = SingleGuideDiagnostics(library, trim=2, interval=5)
+  assert library.count(reads, trim=2, diagnostics=diagnostics).stats['mapped_to_guide_reads'] == 8
+  assert diagnostics.get_results()['diagnosed_reads'] == 2
+  assert diagnostics.get_results()['current_configuration']['mapped_to_guide_reads'] == 2
+
+
+def test_single_guide_library_errors():
+  with pytest.raises(CrisprReadCountsError):
+    SingleGuideLibrary.from_file(os.path.join(test_single_data_dir, 'Human_v1_CRISPR_library.test.lib.csv'))
+  with pytest.raises(CrisprReadCountsError):
+    merge_single_counts([])
+
+
+def test_dual_guide_library_count():
+  library = DualGuideLibrary.from_file(os.path.join(test_dual_data_dir, 'library_parsed_library_for_counting_without_uveal.test.tsv'))
+  left, right = 'TGCTATTGGTCAGCGCATTG', 'GATCAGGGAATCTTTGAGAA'
+  sample = library.count_read_pairs(
+    [('@read1/1\n', right, rev_compl(left)), ('@read2/1\n', left, rev_compl(right))], 'test_sample')
+  stats = sample.get_stats(library)
+  assert stats['total_reads'] == 2
+  assert stats['gRNA1_safe'] == 1
+  assert stats['mismatch'] == 1
+  assert sample.get_row_counts(library)[0] == 1
+
+  sample = library.count_fastq(
+    os.path.join(test_dual_data_dir, 'A375_c9_day_28_1000x_3_r1.test.fq.gz'),
+    os.path.join(test_dual_data_dir, 'A375_c9_day_28_1000x_3_r2.test.fq.gz'),
+    'test_sample')
+  with open(os.path.join(test_dual_data_dir, 'test_dual_stats.test.txt')) as f:
+    expected_stats = f.readlines()[1].strip().split('\t')[1:]
+  assert [str(value) for value in sample.get_stats(library).values()] == expected_stats
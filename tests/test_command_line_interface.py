@@ -4,7 +4,7 @@ from click.testing import CliRunner
 from crispr_read_counts.command_line import cli
 from crispr_read_counts.version import version
 
-SUB_COMMANDS = ['count-single', 'merge-single', 'count-dual']
+SUB_COMMANDS = ['count-single', 'merge-single', 'count-dual', 'compile-plasmid']
 
 def run_command(args: List[str]):
   runner = CliRunner()
@@ -16,6 +16,7 @@ def run_command(args: List[str]):
   ([SUB_COMMANDS[0], '--help'], f'Usage: cli {SUB_COMMANDS[0]} [OPTIONS]'),
   ([SUB_COMMANDS[1], '--help'], f'Usage: cli {SUB_COMMANDS[1]} [OPTIONS]'),
   ([SUB_COMMANDS[2], '--help'], f'Usage: cli {SUB_COMMANDS[2]} [OPTIONS]'),
+  ([SUB_COMMANDS[3], '--help'], f'Usage: cli {SUB_COMMANDS[3]} [OPTIONS]'),
 ])
 def test_basics(args, expected_output):
   result = run_command(args)
@@ -1,7 +1,13 @@
-from crispr_read_counts.dual_guide_count import count_dual
+from crispr_read_counts.dual_guide_count import count_dual, library_to_lookup, sorted_unique_pair_codes, DualGuideLibrary
+from crispr_read_counts.reads_shards import ShardedReadsWriter, compress_bgzf_blocks, BGZF_EOF
+from crispr_read_counts.utils import rev_compl
+from array import array
 import os
 import tempfile
 import filecmp
+import gzip
+import random
+import pysam
 
 test_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'test-dual')
 
@@ -22,6 +28,149 @@ def test_dual_guide_count():
     args['reads'] = os.path.join(tmpd, 'test_dual_classified_reads.test.txt')
     args['stats'] = os.path.join(tmpd, 'test_dual_stats.test.txt')
     args['counts'] = os.path.join(tmpd, 'test_dual_counts.test.txt')
+    for low_memory in (False, True):
+      count_dual({**args, 'low_memory': low_memory})
+      for option, pointing_file in compare_to.items():
+        assert filecmp.cmp(args[option], pointing_file)
+
+
+def test_dual_guide_library_lookup():
+  guide_lib = library_to_lookup(os.path.join(test_data_dir, 'library_parsed_library_for_counting_without_uveal.test.tsv'))
+  assert len(guide_lib) == 10
+  assert len(guide_lib.row_pairs) == 10
+  row_labels = list(guide_lib.iter_row_labels())
+  assert len(row_labels) == 10
+  assert row_labels[0] == b'5431_7_TGCTATTGGTCAGCGCATTG_N_F3_N_NA_POLR2B\tPOLR2B_N_F3\tNA_POLR2B'
+  # repeated target_id and gene_pair_id values are stored once
+  assert len(guide_lib.labels) == len(set(guide_lib.labels))
+  left = guide_lib.guide_index['TGCTATTGGTCAGCGCATTG']
+  right = guide_lib.guide_index['GATCAGGGAATCTTTGAGAA']
+  assert guide_lib.guide_flags[left] == DualGuideLibrary.LEFT
+  assert guide_lib.guide_flags[right] == DualGuideLibrary.RIGHT | DualGuideLibrary.SAFE
+  assert guide_lib.guide_rc_index[rev_compl('TGCTATTGGTCAGCGCATTG')] == left
+  assert guide_lib.pair_index(left, right) >= 0
+  assert guide_lib.pair_index(right, left) == -1
+  assert guide_lib.pair_index_by_seqs('TGCTATTGGTCAGCGCATTG', 'AAAAAAAAAAAAAAAAAAAA') == -1
+
+  # low memory mode looks pairs up in the sorted array, with the same pair indexes
+  low_memory_lib = library_to_lookup(
+    os.path.join(test_data_dir, 'library_parsed_library_for_counting_without_uveal.test.tsv'), low_memory=True)
+  assert low_memory_lib.pair_lookup is None
+  assert list(low_memory_lib.row_pairs) == list(guide_lib.row_pairs)
+  assert low_memory_lib.pair_index(left, right) == guide_lib.pair_index(left, right)
+  assert low_memory_lib.pair_index(right, left) == -1
+
+
+def test_sorted_unique_pair_codes():
+  codes = sorted_unique_pair_codes(array('I', [2, 0, 2, 1, 0]), array('I', [1, 3, 1, 0, 2]), 4)
+  assert list(codes) == [0 << 32 | 2, 0 << 32 | 3, 1 << 32 | 0, 2 << 32 | 1]
+
+
+def test_dual_guide_count_umi():
+  left, right = 'TGCTATTGGTCAGCGCATTG', 'GATCAGGGAATCTTTGAGAA'
+  with tempfile.TemporaryDirectory() as tmpd:
+    args = {
+      'library': os.path.join(test_data_dir, 'library_parsed_library_for_counting_without_uveal.test.tsv'),
+      'fastq1': os.path.join(tmpd, 'r1.fq'),
+      'fastq2': os.path.join(tmpd, 'r2.fq'),
+      'sample': 'test_sample',
+      'umi_regex': r'RX:Z:([ACGTN]+)',
+      'reads': os.path.join(tmpd, 'reads.txt'),
+      'stats': os.path.join(tmpd, 'stats.txt'),
+      'counts': os.path.join(tmpd, 'counts.txt')
+    }
+    with open(args['fastq1'], 'w') as fq1, open(args['fastq2'], 'w') as fq2:
+      for index, umi in enumerate(['AACC', 'AACC', 'GGTT', 'AACC']):
+        fq1.write(f'@read{index}/1 RX:Z:{umi}\n{right}\n+\n{"I" * 20}\n')
+        fq2.write(f'@read{index}/2 RX:Z:{umi}\n{rev_compl(left)}\n+\n{"I" * 20}\n')
+    count_dual(args)
+    with open(args['counts']) as f:
+      assert f.readline().strip().split('\t')[3:] == ['test_sample', 'test_sample.dedup']
+      assert f.readline().strip().split('\t')[3:] == ['4', '2']
+
+
+def test_dual_guide_count_barcodes():
+  left, right = 'TGCTATTGGTCAGCGCATTG', 'GATCAGGGAATCTTTGAGAA'
+  with tempfile.TemporaryDirectory() as tmpd:
+    args = {
+      'library': os.path.join(test_data_dir, 'library_parsed_library_for_counting_without_uveal.test.tsv'),
+      'fastq1': os.path.join(tmpd, 'r1.fq'),
+      'fastq2': os.path.join(tmpd, 'r2.fq'),
+      'barcodes': os.path.join(tmpd, 'barcodes.tsv'),
+      'reads': os.path.join(tmpd, 'reads.txt'),
+      'stats': os.path.join(tmpd, 'stats.txt'),
+      'counts': os.path.join(tmpd, 'counts.txt')
+    }
+    with open(args['barcodes'], 'w') as f:
+      f.write('sample\tbarcode\nsample_a\tAAAA\nsample_b\tCCCC\n')
+    with open(args['fastq1'], 'w') as fq1, open(args['fastq2'], 'w') as fq2:
+      for index, barcode in enumerate(['AAAA', 'CCCC', 'AAAA', 'GGGG']):
+        fq1.write(f'@read{index}/1\n{barcode}{right}\n+\n{"I" * 24}\n')
+        fq2.write(f'@read{index}/2\n{rev_compl(left)}\n+\n{"I" * 20}\n')
     count_dual(args)
-    for option, pointing_file in compare_to.items():
-      assert filecmp.cmp(args[option], pointing_file)
+    with open(args['counts']) as f:
+      assert f.readline().strip().split('\t')[3:] == ['sample_a', 'sample_b']
+      assert f.readline().strip().split('\t')[3:] == ['2', '1']
+    with open(args['stats']) as f:
+      assert [line.split('\t')[:2] for line in f.readlines()[1:]] == [['sample_a', '2'], ['sample_b', '1']]
+    with open(args['reads']) as f:
+      assert [line.split('\t')[2] for line in f] == ['sample_a', 'sample_b', 'sample_a']
+
+
+def test_dual_guide_count_reads_shards():
+  args = {
+    'library': os.path.join(test_data_dir, 'library_parsed_library_for_counting_without_uveal.test.tsv'),
+    'fastq1': os.path.join(test_data_dir, 'A375_c9_day_28_1000x_3_r1.test.fq.gz'),
+    'fastq2': os.path.join(test_data_dir, 'A375_c9_day_28_1000x_3_r2.test.fq.gz'),
+    'sample': 'test_sample',
+    'reads_shards': 2
+  }
+  with open(os.path.join(test_data_dir, 'test_dual_classified_reads.test.txt'), 'rb') as f:
+    expected_reads = f.read()
+  with tempfile.TemporaryDirectory() as tmpd:
+    args['reads'] = os.path.join(tmpd, 'reads.txt')
+    args['stats'] = os.path.join(tmpd, 'stats.txt')
+    args['counts'] = os.path.join(tmpd, 'counts.txt')
+    count_dual(args)
+    assert filecmp.cmp(args['counts'], os.path.join(test_data_dir, 'test_dual_counts.test.txt'))
+    assert not os.path.exists(args['reads'])
+    with gzip.open(os.path.join(tmpd, 'reads.txt.0.gz'), 'rb') as f:
+      assert f.read() == expected_reads
+
+    # many chunks: the chunk byte ranges listed in the index make the reads in order
+    lines = expected_reads.decode().splitlines(keepends=True)
+    out_reads = os.path.join(tmpd, 'chunked_reads.txt')
+    with ShardedReadsWriter(out_reads, 3, chunk_reads=150) as writer:
+      for line in lines:
+        writer.write(line)
+    concatenated = b''
+    with open(f'{out_reads}.index.tsv') as f:
+      assert f.readline() == 'shard\toffset\tsize\treads\n'
+      index = [line.rstrip('\n').split('\t') for line in f]
+    assert [row[0] for row in index[:4]] == ['chunked_reads.txt.0.gz', 'chunked_reads.txt.1.gz', 'chunked_reads.txt.2.gz', 'chunked_reads.txt.0.gz']
+    assert sum(int(row[3]) for row in index) == len(lines)
+    for shard, offset, size, _ in index:
+      with open(os.path.join(tmpd, shard), 'rb') as f:
+        f.seek(int(offset))
+        concatenated += f.read(int(size))
+    assert gzip.decompress(concatenated) == expected_reads
+
+
+def test_compress_bgzf_blocks():
+  rng = random.Random(0)
+  data = ''.join(rng.choice('ACGT\n') for _ in range(200000)).encode()
+  compressed = compress_bgzf_blocks(data)
+  # blocks of at most 64 KiB, each giving its size in the BC extra field
+  offset, n_blocks = 0, 0
+  while offset < len(compressed):
+    assert compressed[offset:offset + 4] == b'\x1f\x8b\x08\x04' and compressed[offset + 12:offset + 14] == b'BC'
+    offset += int.from_bytes(compressed[offset + 16:offset + 18], 'little') + 1
+    n_blocks += 1
+  assert offset == len(compressed)
+  assert n_blocks == 4
+  with tempfile.TemporaryDirectory() as tmpd:
+    path = os.path.join(tmpd, 'reads.gz')
+    with open(path, 'wb') as f:
+      f.write(compressed + BGZF_EOF)
+    with pysam.BGZFile(path, 'rb') as f:
+      assert f.read() == data
@@ -0,0 +1,111 @@
+from crispr_read_counts.prefetch import PrefetchingReader
+from crispr_read_counts.dual_guide_count import DualGuideLibrary
+from crispr_read_counts.utils import open_plain_or_gzipped_file, CrisprReadCountsError
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+from threading import Thread
+from contextlib import contextmanager
+import os
+import re
+import gzip
+import pytest
+
+test_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
+test_fastq = os.path.join(test_data_dir, 'test-dual', 'A375_c9_day_28_1000x_3_r1.test.fq.gz')
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+  '''
+  stand-in of an object store with presigned URLs: serves files of a directory, with support of single byte range
+  requests, and rejects HEAD requests as URLs signed for GET.
+  '''
+  support_range = True
+
+  def do_HEAD(self):
+    self.send_error(403)
+
+  def send_head(self):
+    range_match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+    if not (range_match and self.support_range):
+      return super().send_head()
+    path = self.translate_path(self.path)
+    if not os.path.isfile(path):
+      self.send_error(404)
+      return None
+    f = open(path, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    start, end = int(range_match.group(1)), min(int(range_match.group(2)), size - 1)
+    f.seek(start)
+    self.send_response(206)
+    self.send_header('Content-Length', str(end - start + 1))
+    self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+    self.end_headers()
+    return RangeFile(f, end - start + 1)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class RangeFile:
+
+  def __init__(self, f, size):
+    self.f = f
+    self.size = size
+
+  def read(self, size=-1):
+    size = self.size if size < 0 else min(size, self.size)
+    self.size -= size
+    return self.f.read(size)
+
+  def close(self):
+    self.f.close()
+
+
+@contextmanager
+def serve_test_data(support_range=True):
+  handler = type('Handler', (RangeRequestHandler,), {'support_range': support_range})
+  server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=test_data_dir))
+  thread = Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  try:
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def test_prefetching_reader():
+  with open(test_fastq, 'rb') as f:
+    expected = f.read()
+  with PrefetchingReader(test_fastq, threads=3, block_size=1000) as reader:
+    assert reader.read() == expected
+
+  with serve_test_data() as url:
+    with PrefetchingReader(f'{url}/test-dual/{os.path.basename(test_fastq)}', threads=3, block_size=1000) as reader:
+      assert reader.read() == expected
+
+    with open_plain_or_gzipped_file(f'{url}/test-dual/{os.path.basename(test_fastq)}') as f:
+      with gzip.open(test_fastq, 'rt') as expected_f:
+        assert f.read() == expected_f.read()
+
+    with pytest.raises(CrisprReadCountsError):
+      PrefetchingReader(f'{url}/test-dual/missing.fq.gz')
+
+  with serve_test_data(support_range=False) as url:
+    with pytest.raises(CrisprReadCountsError):
+      with PrefetchingReader(f'{url}/test-dual/{os.path.basename(test_fastq)}') as reader:
+        reader.read()
+
+
+def test_dual_guide_count_url():
+  library = DualGuideLibrary.from_file(os.path.join(test_data_dir, 'test-dual', 'library_parsed_library_for_counting_without_uveal.test.tsv'))
+  fastq2 = test_fastq.replace('_r1.', '_r2.')
+  expected = library.count_fastq(test_fastq, fastq2, 'test_sample')
+  with serve_test_data() as url:
+    sample = library.count_fastq(
+      f'{url}/test-dual/{os.path.basename(test_fastq)}', f'{url}/test-dual/{os.path.basename(fastq2)}', 'test_sample')
+  assert sample.get_stats(library) == expected.get_stats(library)
+  assert list(sample.pair_counts) == list(expected.pair_counts)
+
+  sample = library.count_fastq(test_fastq, fastq2, 'test_sample', prefetch_threads=2)
+  assert sample.get_stats(library) == expected.get_stats(library)
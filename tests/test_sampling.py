@@ -0,0 +1,189 @@
+from crispr_read_counts.sampling import (
+  FastqSampler,
+  sampled_cram,
+  check_sampling_options,
+  estimate_full_depth_stats,
+  chunked_hit_rate_interval,
+  resample_histogram,
+  wilson_interval)
+from crispr_read_counts.single_guide_count import SingleGuideLibrary
+from crispr_read_counts.dual_guide_count import count_dual, fastq_read_pairs
+from crispr_read_counts.utils import CrisprReadCountsError
+import os
+import gzip
+import random
+import tempfile
+import pysam
+import pytest
+
+test_dual_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'test-dual')
+test_single_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'test-single')
+test_fastqs = [os.path.join(test_dual_data_dir, f'A375_c9_day_28_1000x_3_{read}.test.fq.gz') for read in ('r1', 'r2')]
+
+
+def write_bgzf_copies(tmpd):
+  bgzf_fastqs = []
+  for fastq in test_fastqs:
+    bgzf_fastq = os.path.join(tmpd, os.path.basename(fastq))
+    with gzip.open(fastq, 'rb') as f, pysam.BGZFile(bgzf_fastq, 'wb') as out:
+      out.write(f.read())
+    bgzf_fastqs.append(bgzf_fastq)
+  return bgzf_fastqs
+
+
+def test_fastq_sampler():
+  with gzip.open(test_fastqs[0], 'rt') as fq1, gzip.open(test_fastqs[1], 'rt') as fq2:
+    all_pairs = list(fastq_read_pairs(fq1, fq2))
+
+  with tempfile.TemporaryDirectory() as tmpd:
+    fastq1, fastq2 = write_bgzf_copies(tmpd)
+
+    sampler = FastqSampler(fastq1, fastq2, sample_reads=100)
+    pairs = list(sampler)
+    assert len(pairs) == 100
+    assert len(set(pairs)) == 100
+    assert set(pairs) <= set(all_pairs)
+    # sampled pairs are spread across the files
+    assert pairs[-1] in all_pairs[1000:]
+    assert sampler.fraction == pytest.approx(100 / len(all_pairs), rel=0.1)
+
+    sampler = FastqSampler(fastq1, sample_fraction=1.0)
+    reads = list(sampler)
+    assert [seq for seq, _ in reads] == [seq1 for _, seq1, _ in all_pairs]
+    assert reads[0][1] == all_pairs[0][0][1:-1]
+    assert sampler.fraction == 1.0
+
+  with pytest.raises(CrisprReadCountsError):
+    list(FastqSampler(test_fastqs[0], sample_reads=100))
+
+
+def test_dual_guide_count_sampled():
+  with tempfile.TemporaryDirectory() as tmpd:
+    fastq1, fastq2 = write_bgzf_copies(tmpd)
+    args = {
+      'library': os.path.join(test_dual_data_dir, 'library_parsed_library_for_counting_without_uveal.test.tsv'),
+      'fastq1': fastq1,
+      'fastq2': fastq2,
+      'sample': 'test_sample',
+      'reads': os.path.join(tmpd, 'reads.txt'),
+      'stats': os.path.join(tmpd, 'stats.txt'),
+      'counts': os.path.join(tmpd, 'counts.txt'),
+      'sample_reads': 500,
+    }
+    count_dual(args)
+    with open(args['stats']) as f:
+      stats = dict(zip(*[line.rstrip('\n').split('\t') for line in f]))
+    with open(args['reads']) as f:
+      assert len(f.readlines()) == int(stats['total_reads'])
+  assert stats['total_reads'] == stats['sampled_reads']
+  assert int(stats['total_reads']) == pytest.approx(500, rel=0.1)
+  assert int(stats['estimated_total_reads']) == pytest.approx(2000, rel=0.1)
+  assert float(stats['hit_rate_ci_low']) <= float(stats['hit_rate']) <= float(stats['hit_rate_ci_high'])
+  assert 'estimated_less_30_guides_ci_high' in stats
+
+
+def test_single_guide_count_sampled_cram():
+  library = SingleGuideLibrary.from_file(os.path.join(test_single_data_dir, 'Human_v1_CRISPR_library.test.lib.tsv'))
+  rng = random.Random(0)
+  header = {'HD': {'VN': '1.6', 'SO': 'unsorted'}, 'SQ': [{'SN': 'chr1', 'LN': 100}], 'RG': [{'ID': 'rg1', 'SM': 'test'}]}
+  with tempfile.TemporaryDirectory() as tmpd:
+    ref, cram = os.path.join(tmpd, 'genome.fa'), os.path.join(tmpd, 'test.cram')
+    with open(ref, 'w') as f:
+      f.write('>chr1\n' + 'A' * 100 + '\n')
+    # small slices for the file to have many containers
+    with pysam.AlignmentFile(cram, 'wc', header=header, reference_filename=ref, format_options=[b'seqs_per_slice=100']) as f:
+      for index in range(4000):
+        read = pysam.AlignedSegment(f.header)
+        read.query_name = f'read{index}'
+        read.query_sequence = rng.choice(library.seqs) if index % 2 else 'A' * 20
+        read.query_qualities = pysam.qualitystring_to_array('I' * len(read.query_sequence))
+        read.flag = 4
+        f.write(read)
+
+    with sampled_cram(cram, sample_reads=1000) as (sample_file, fraction, chunk_records):
+      with pysam.AlignmentFile(sample_file, 'rc', reference_filename=ref) as f:
+        assert sum(1 for _ in f.fetch(until_eof=True)) == fraction * 4000 == sum(chunk_records)
+    assert 0.2 <= fraction <= 0.3
+
+    result = library.count_cram(cram, ref, sample_reads=1000)
+  assert result.sample_name == 'test'
+  assert result.stats['sampled_reads'] == result.stats['total_reads'] == fraction * 4000
+  assert result.stats['mapped_to_guide_reads'] == result.stats['total_reads'] / 2
+  assert result.stats['estimated_total_reads'] == 4000
+  assert result.stats['hit_rate'] == 0.5
+  assert [reads for reads, _ in result.chunk_hits] == chunk_records
+  assert sum(hits for _, hits in result.chunk_hits) == result.stats['mapped_to_guide_reads']
+
+
+def test_estimate_full_depth_stats():
+  low, high = wilson_interval(50, 100)
+  assert low < 0.5 < high
+  assert wilson_interval(0, 0) == (0.0, 1.0)
+
+  # nothing is left to extrapolate from a full sample
+  counts = [0, 0, 5, 20, 40, 100]
+  estimates = estimate_full_depth_stats(counts, 1000, 165, 1.0, 30)
+  assert estimates['estimated_total_reads'] == 1000
+  assert estimates['estimated_zero_guides'] == 2
+  assert estimates['estimated_low_guides'] == 4
+
+  rng = random.Random(0)
+  # guides with a dropout
+  full_counts = [0 if rng.random() < 0.02 else int(rng.lognormvariate(4, 0.8)) for _ in range(2000)]
+  n_zero, n_low = full_counts.count(0), sum(1 for count in full_counts if count < 30)
+
+  def sample_counts(fraction):
+    return [sum(1 for _ in range(count) if rng.random() < fraction) for count in full_counts]
+
+  # a guide at the threshold has about 1 read in 1% of the reads, nothing is estimated but the bounds still hold
+  sampled_counts = sample_counts(0.01)
+  estimates = estimate_full_depth_stats(sampled_counts, 1000, 500, 0.01, 30)
+  assert estimates['estimated_zero_guides'] is None
+  assert estimates['estimated_low_guides'] is None
+  assert estimates['estimated_zero_guides_ci_low'] == 0
+  assert estimates['estimated_zero_guides_ci_high'] == sampled_counts.count(0)
+  assert estimates['estimated_low_guides_ci_low'] <= n_low <= estimates['estimated_low_guides_ci_high']
+  assert estimates['estimated_zero_guides_ci_low'] <= n_zero <= estimates['estimated_zero_guides_ci_high']
+
+  # the low count guides intervals cover the full depth number in about 95% of the samples, zero count guides are only
+  # bounded
+  n_low_covered = 0
+  for _ in range(10):
+    sampled_counts = sample_counts(0.2)
+    estimates = estimate_full_depth_stats(sampled_counts, 1000, 500, 0.2, 30)
+    n_low_covered += estimates['estimated_low_guides_ci_low'] <= n_low <= estimates['estimated_low_guides_ci_high']
+    assert estimates['estimated_zero_guides'] is None
+    assert estimates['estimated_zero_guides_ci_low'] == 0
+    assert estimates['estimated_zero_guides_ci_high'] == sampled_counts.count(0) >= n_zero
+  assert n_low_covered >= 8
+
+  # no guide is sampled below the threshold
+  estimates = estimate_full_depth_stats([40, 50], 1000, 90, 0.5, 30)
+  assert estimates['estimated_zero_guides'] == estimates['estimated_low_guides'] == 0
+  assert estimates['estimated_low_guides_ci_high'] == 0
+
+
+def test_resample_histogram():
+  rng = random.Random(0)
+  count_hist = {0: 5, 1: 300, 30: 1000000}
+  resamples = [resample_histogram(rng, count_hist) for _ in range(200)]
+  assert all(sum(resample.values()) == sum(count_hist.values()) for resample in resamples)
+  assert sum(resample.get(1, 0) for resample in resamples) / len(resamples) == pytest.approx(300, rel=0.05)
+
+
+def test_chunked_hit_rate_interval():
+  # the same hit rate in every chunk: as precise as independent reads
+  assert chunked_hit_rate_interval([(100, 50)] * 10) == wilson_interval(500, 1000)
+  assert chunked_hit_rate_interval([(1000, 500)]) == wilson_interval(500, 1000)
+  # hit rate varying between chunks: wider than the interval of independent reads
+  low, high = chunked_hit_rate_interval([(100, 20), (100, 80)] * 5)
+  wilson_low, wilson_high = wilson_interval(500, 1000)
+  assert low < wilson_low < 0.5 < wilson_high < high
+
+
+def test_check_sampling_options():
+  check_sampling_options(100, None)
+  check_sampling_options(None, 0.5)
+  for sample_reads, sample_fraction in [(100, 0.5), (0, None), (None, 0.0), (None, 1.5)]:
+    with pytest.raises(CrisprReadCountsError):
+      check_sampling_options(sample_reads, sample_fraction)
@@ -1,10 +1,13 @@
 import pytest
 from typing import List, Dict
-from crispr_read_counts.single_guide_count import check_files, count_single
+from crispr_read_counts.single_guide_count import check_files, count_single, compile_plasmid, SingleGuideReadCounts, SingleGuideLibrary
+from crispr_read_counts.plasmid import load_plasmid_counts, read_plasmid_counts_tsv, get_library_fingerprint
+from crispr_read_counts.utils import CrisprReadCountsError
 from crispr_read_counts.single_guide_merge import merge_single
 import os
 import tempfile
 import filecmp
+import pysam
 
 test_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
 test_single_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data', 'test-single')
@@ -84,6 +87,66 @@ def test_single_count(args, expected_output):
       assert filecmp.cmp(args[key], pointing_file)
 
 
+def write_umi_cram(tmpd: str, reads: List):
+  '''
+  write unmapped (sequence, UMI) reads to a CRAM file, UMIs are in RX tags and at the end of read names.
+  '''
+  ref, cram = os.path.join(tmpd, 'genome.fa'), os.path.join(tmpd, 'umi.cram')
+  with open(ref, 'w') as f:
+    f.write('>chr1\n' + 'A' * 100 + '\n')
+  header = {'HD': {'VN': '1.6', 'SO': 'unsorted'}, 'SQ': [{'SN': 'chr1', 'LN': 100}], 'RG': [{'ID': 'rg1', 'SM': 'umi'}]}
+  with pysam.AlignmentFile(cram, 'wc', header=header, reference_filename=ref) as f:
+    for index, (seq, umi) in enumerate(reads):
+      read = pysam.AlignedSegment(f.header)
+      read.query_name = f'read{index}_{umi}'
+      read.query_sequence = seq
+      read.query_qualities = pysam.qualitystring_to_array('I' * len(seq))
+      read.flag = 4
+      read.set_tag('RX', umi)
+      f.write(read)
+  return cram, ref
+
+
+def test_single_count_umi():
+  library = SingleGuideLibrary.from_file(TEST_INPUTS['library'])
+  guide1, guide2 = library.seqs[0], library.seqs[1]
+  reads = [(guide1, 'AAAA'), (guide1, 'AAAA'), (guide1, 'CCCC'), (guide2, 'GGGG'), ('T' * len(guide1), 'TTTT')]
+  sgrna_id = library.lib[guide1][0]
+  with tempfile.TemporaryDirectory() as tmpd:
+    cram, ref = write_umi_cram(tmpd, reads)
+    outputs = []
+    for umi_options in ({'umi_tag': 'RX'}, {'umi_regex': '_([ACGT]+)$'}):
+      args = {**TEST_INPUTS, **umi_options, 'input': cram, 'ref': ref, 'plasmid': None,
+              'output': os.path.join(tmpd, f'counts{len(outputs)}.txt'), 'stats': os.path.join(tmpd, 'stats.txt')}
+      count_single(args)
+      with open(args['output']) as f:
+        rows = [line.rstrip('\n').split('\t') for line in f]
+      assert rows[0] == ['sgRNA', 'gene', 'umi.sample', 'umi.sample.dedup']
+      assert {row[0]: row[2:] for row in rows[1:]}[sgrna_id] == ['3', '2']
+      outputs.append(args['output'])
+
+    # deduplicated counts of count files can not be merged, an UMI seen in both files would be counted twice
+    merged = os.path.join(tmpd, 'merged.txt')
+    merge_single({'input': ','.join(outputs), 'output': merged, 'plasmid': False, 'stats': None})
+    with open(merged) as f:
+      rows = [line.rstrip('\n').split('\t') for line in f]
+    assert rows[0] == ['sgRNA', 'gene', 'umi.sample']
+    assert {row[0]: row[2:] for row in rows[1:]}[sgrna_id] == ['6']
+
+    # the deduplicated counts column is not a plasmid counts column
+    with pytest.raises(SystemExit):
+      merge_single({'input': ','.join(outputs), 'output': merged, 'plasmid': True, 'stats': None})
+
+    args = {**args, 'plasmid': TEST_INPUTS['plasmid'], 'output': os.path.join(tmpd, 'counts_plasmid.txt')}
+    count_single(args)
+    merge_single({'input': f'{args["output"]},{args["output"]}', 'output': merged, 'plasmid': True, 'stats': None})
+    with open(merged) as f:
+      rows = [line.rstrip('\n').split('\t') for line in f]
+    assert rows[0] == ['sgRNA', 'gene', 'umi.sample', 'ERS717283.plasmid']
+    plasmid_count = read_plasmid_counts_tsv(TEST_INPUTS['plasmid'], library).as_dict(library)[sgrna_id]
+    assert {row[0]: row[2:] for row in rows[1:]}[sgrna_id] == ['6', str(plasmid_count)]
+
+
 @pytest.mark.parametrize('args, compare_to', [
   ({'input': '{0},{0}'.format(os.path.join(test_single_data_dir, 'test.crispr.count.with_plasmid.txt')),
     'plasmid': True, 'stats': None},
@@ -102,3 +165,49 @@ def test_merge_single(args: Dict[str, str], compare_to: Dict[str, str]):
     assert filecmp.cmp(args['output'], compare_to['merged_count'])
     if args['stats']:
       assert filecmp.cmp(args['stats'], compare_to['stats'])
+
+
+def test_compile_plasmid():
+  plasmid_tsv = TEST_INPUTS['plasmid']
+  with open(plasmid_tsv) as f:
+    expected = {line.split('\t')[0]: int(line.rstrip('\n').split('\t')[2]) for line in list(f)[1:]}
+  with tempfile.TemporaryDirectory() as tmpd:
+    compiled = os.path.join(tmpd, 'plasmid.bin')
+    compile_plasmid({'plasmid': plasmid_tsv, 'library': TEST_INPUTS['library'], 'output': compiled, 'lib_delimiter': '\t'})
+
+    counter = SingleGuideReadCounts(TEST_INPUTS['library'], '\t', None, os.path.join(tmpd, 'output.txt'), None)
+    library = counter.library
+    reads = [library.seqs[0], library.seqs[0], library.seqs[-1], 'T' * 20]
+    outputs = []
+    for plasmid_file in (plasmid_tsv, compiled):
+      plasmid = load_plasmid_counts(plasmid_file, library)
+      assert plasmid.name == 'ERS717283.plasmid'
+      assert plasmid.as_dict(library) == {sgrna_id: expected.get(sgrna_id, 0) for sgrna_id in library.guide_ids}
+      counter.plasmid, counter.plas_name = plasmid, plasmid.name
+      counter.result = library.count(reads, sample_name='test')
+      counter.write_output(None)
+      with open(counter.out_count) as f:
+        outputs.append(f.read())
+    assert outputs[0] == outputs[1]
+    assert outputs[0].split('\n')[0] == 'sgRNA\tgene\ttest.sample\tERS717283.plasmid'
+    # the library fingerprint is only computed for compiled files
+    assert load_plasmid_counts(plasmid_tsv, library).fingerprint is None
+    assert load_plasmid_counts(compiled, library).fingerprint == get_library_fingerprint(library)
+
+    # compiled counts are aligned with the guides of the library they were compiled for
+    other_library = SingleGuideLibrary({seq: library.lib[seq] for seq in library.seqs[1:]}, library.targeted_genes)
+    with pytest.raises(CrisprReadCountsError):
+      load_plasmid_counts(compiled, other_library)
+    # same number of guides, one guide sequence changed
+    changed_library = SingleGuideLibrary(
+      {('T' * 20 if seq == library.seqs[0] else seq): library.lib[seq] for seq in library.seqs}, library.targeted_genes)
+    assert len(changed_library) == len(library)
+    with pytest.raises(CrisprReadCountsError):
+      load_plasmid_counts(compiled, changed_library)
+    assert len(read_plasmid_counts_tsv(plasmid_tsv, other_library).counts) == len(other_library)
+
+    invalid_tsv = os.path.join(tmpd, 'invalid_plasmid.tsv')
+    with open(plasmid_tsv) as f, open(invalid_tsv, 'w') as out:
+      out.write(f.read() + 'extra_guide\tgene\t1.5\n')
+    with pytest.raises(SystemExit):
+      compile_plasmid({'plasmid': invalid_tsv, 'library': TEST_INPUTS['library'], 'output': compiled, 'lib_delimiter': '\t'})
@@ -0,0 +1,33 @@
+import re
+from crispr_read_counts.utils import UmiCounts, SpaceSavingCounter, get_umi_from_read_name
+
+
+def test_umi_counts():
+  umi_counts = UmiCounts(3)
+  assert umi_counts.add(0, 'ACGTACGT')
+  assert not umi_counts.add(0, 'ACGTACGT')
+  assert umi_counts.add(1, 'ACGTACGT')
+  long_umi = 'ACGT' * 5
+  assert umi_counts.add(2, long_umi)
+  assert not umi_counts.add(2, long_umi)
+  assert umi_counts.add(2, long_umi[:12])
+  assert list(umi_counts.counts) == [1, 1, 2]
+  assert len(umi_counts.seen) == 4
+
+
+def test_get_umi_from_read_name():
+  assert get_umi_from_read_name(re.compile(r'_([ACGTN]+)$'), 'read1_ACGTT') == 'ACGTT'
+  assert get_umi_from_read_name(re.compile(r'[ACGTN]{5}$'), 'read1_ACGTT') == 'ACGTT'
+  assert get_umi_from_read_name(re.compile(r'_([ACGTN]+)$'), 'read1') is None
+
+
+def test_space_saving_counter():
+  counter = SpaceSavingCounter(3)
+  for item in ['a', 'b', 'a', 'c', 'a', 'b', 'd', 'e', 'a']:
+    counter.add(item)
+  assert counter.total == 9
+  assert len(counter.counts) == 3
+  top = counter.top(2)
+  assert top[0] == ('a', 4, 0)
+  # counts of kept items are never under counted
+  assert all(count - overcount <= ['a', 'b', 'a', 'c', 'a', 'b', 'd', 'e', 'a'].count(item) <= count for item, count, overcount in counter.top(3))